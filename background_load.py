@@ -0,0 +1,104 @@
+# Non-blocking startup for the Dash apps: the data is loaded and prepared in a background thread while the server already
+# answers requests (with a loading state), instead of app.run waiting for the whole download/parse/prep
+#   pending = BackgroundLoad(lambda: load_n_prep_data(filename), "covid").start()
+#   add_health_routes(app.server, pending.status)     # GET /health (liveness) and GET /ready (503 until loaded)
+#   open_browser_when_ready("http://127.0.0.1:8050/")   # the tab opens once the server answers, not before
+import os
+import threading
+import time
+import traceback
+import urllib.request
+import webbrowser as wb
+
+READY_POLL_S = 0.25 # How often open_browser_when_ready checks the server
+READY_TIMEOUT_S = 60 # Gives up opening the browser if the server isn't up by then
+
+class BackgroundLoad:
+    def __init__(self, load, name="data"):
+        # load() is run once, in a daemon thread, by start(). Its return value is result()
+        self.load = load
+        self.name = name
+        self.state = "idle" # idle -> loading -> ready or failed
+        self.error = None
+        self.started = None
+        self.seconds = None
+        self.value = None
+        self.done = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.state = "loading"
+            self.started = time.time()
+            self.thread = threading.Thread(target=self.run, name=f"load-{self.name}", daemon=True)
+            self.thread.start()
+        return self
+
+    def run(self):
+        print(f"Loading {self.name} in the background...")
+        try:
+            self.value = self.load()
+            self.state = "ready"
+        except Exception as e: # Kept for /health and result(), the server stays up to report it
+            self.error = f"{type(e).__name__}: {e}"
+            self.state = "failed"
+            traceback.print_exc()
+        finally:
+            self.seconds = round(time.time() - self.started, 3)
+            self.done.set()
+        print(f"Background load of {self.name} {self.state} after {self.seconds}s...")
+
+    def ready(self):
+        return self.state == "ready"
+
+    def result(self, timeout=None):
+        # The loaded value, waiting up to timeout seconds for it (None waits as long as it takes). Raises if the load failed
+        if not self.done.wait(timeout):
+            raise TimeoutError(f"{self.name} still loading")
+        if self.state == "failed":
+            raise RuntimeError(f"Loading {self.name} failed: {self.error}")
+        return self.value
+
+    def status(self):
+        status = {"name": self.name, "state": self.state, "ready": self.ready()}
+        if self.started is not None:
+            status["seconds"] = self.seconds if self.seconds is not None else round(time.time() - self.started, 3)
+        if self.error:
+            status["error"] = self.error
+        return status
+
+def add_health_routes(server, status):
+    # GET /health: 200 as long as the process serves requests, with status() as JSON (liveness)
+    # GET /ready: the same, but 503 until status()["ready"] (readiness, e.g. for a load balancer or a k8s probe)
+    @server.route("/health")
+    def health():
+        return status()
+
+    @server.route("/ready")
+    def ready():
+        current = status()
+        return current, 200 if current["ready"] else 503
+
+def is_reloader_watcher(debug):
+    # True in the process werkzeug's reloader (app.run(debug=True)) only watches the files from. It never serves a request,
+    # so loading there is wasted work. It is also the one process that lives across code reloads, the place to open a browser
+    return debug and os.environ.get("WERKZEUG_RUN_MAIN") != "true"
+
+def open_browser_when_ready(url, health_url=None, timeout=READY_TIMEOUT_S):
+    # Opens url in a browser tab once GET health_url (url + "health" by default) answers, from a thread so app.run can start
+    health_url = health_url or url.rstrip("/") + "/health"
+
+    def wait_and_open():
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                with urllib.request.urlopen(health_url, timeout=READY_POLL_S * 4):
+                    wb.open_new_tab(url)
+                    return
+            except OSError: # Connection refused until the server listens
+                time.sleep(READY_POLL_S)
+        print(f"{health_url} didn't answer within {timeout}s, not opening the browser...")
+
+    thread = threading.Thread(target=wait_and_open, name="open-browser", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,234 @@
+# Headless nightly snapshots: one COVID trend figure per State x metric (plotly_explore.prep_fig) and one org chart per TC
+# (pyvis html + cytoscape elements json). Datasets are loaded and prepared once, jobs are spread over a process pool
+# Usage: python batch_render.py --covid data/districts.csv --org data/VW_COMMERCIAL_BARCLAYS_INFO_202108061114.xlsx --out snapshots
+# Re-running with the same --out skips jobs already done for the same data, so a killed run picks up where it stopped
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+import plotly.io as pio
+import plotly.offline
+
+from data_cache import cached_frame, read_cached, write_cached
+from plotly_explore import load_n_prep_data, build_filter_index, prep_fig
+from cytoscape_explore import prep_org_data, prep_graph_elements, NULL_FILLER
+from org_layout import cached_layout_positions, LAYOUT_CACHE_DIR
+import pyvis_explore
+
+METRICS = ["Confirmed","Confirmed_i","Active","Active_i","Deceased","Deceased_i"] # Same as the plotly_explore dropdown
+FIG_OPTION = 4 # prep_fig option, one line per District of the State
+MANIFEST = "manifest.jsonl" # One line per finished job, in the output directory
+NO_TC = "no_TC" # File name of the chart of the employees without a TC
+
+try:
+    import kaleido # Static images need kaleido (pip install kaleido), which renders offline
+except ImportError:
+    kaleido = None
+
+shared = {} # Prepared datasets, read only in the workers. Inherited on fork, read from the parent's saved copy otherwise
+
+def slug(text):
+    return re.sub(r"[^A-Za-z0-9]+", "_", str(text)).strip("_") or "_"
+
+def fingerprint(df):
+    # Content hash of a prepared frame, so a resumed run only skips jobs rendered from the same data
+    return f"{pd.util.hash_pandas_object(df, index=True).sum():016x}"
+
+def load_datasets(covid_source, org_source):
+    datasets = {}
+    if covid_source:
+        cv_df = cached_frame(covid_source, load_n_prep_data)
+        datasets["covid"] = {"cv_df": cv_df, "filter_index": build_filter_index(cv_df)}
+    if org_source:
+        org_df = cached_frame(org_source, pyvis_explore.load_data) # Raw extract on EMP_CODE, for pyvis
+        graph_df = prep_org_data(org_df.reset_index()) # For cytoscape
+        datasets["org"] = {"org_df": org_df, "graph_df": graph_df, "positions": cached_layout_positions(graph_df)}
+    return datasets
+
+def save_datasets(datasets, directory):
+    # Writes the prepared datasets for spawned workers, returns {kind: {name: path}} for load_saved_datasets.
+    # Frames as feather files (see data_cache), positions as json. The filter index is rebuilt, it is quick
+    paths = {}
+    for kind, data in datasets.items():
+        paths[kind] = {}
+        for name, value in data.items():
+            if isinstance(value, pd.DataFrame):
+                paths[kind][name] = os.path.join(directory, f"{kind}-{name}.feather")
+                write_cached(value, paths[kind][name])
+            elif name == "positions":
+                paths[kind][name] = os.path.join(directory, f"{kind}-{name}.json")
+                write_file(paths[kind][name], json.dumps(value))
+    return paths
+
+def load_saved_datasets(paths):
+    datasets = {}
+    for kind, files in paths.items():
+        datasets[kind] = {}
+        for name, path in files.items():
+            if path.endswith(".feather"):
+                datasets[kind][name] = read_cached(path)
+            else:
+                with open(path) as f:
+                    datasets[kind][name] = json.load(f)
+    if "covid" in datasets:
+        datasets["covid"]["filter_index"] = build_filter_index(datasets["covid"]["cv_df"])
+    return datasets
+
+def init_worker(paths):
+    if not shared: # Spawned rather than forked. Reads what the parent prepared, the sources aren't downloaded or parsed again
+        shared.update(load_saved_datasets(paths))
+
+def write_file(path, content):
+    # Atomic, so an interrupted run never leaves a half written file that looks done
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(path + ".tmp", path)
+
+def render_covid(out_dir, state, metric, images):
+    data = shared["covid"]
+    fig = prep_fig(data["cv_df"], f'State=="{state}"', metric, FIG_OPTION, filter_index=data["filter_index"])
+    fig.update_layout(title=f"{state} - {metric}")
+    base = os.path.join(out_dir, "covid", f"{slug(state)}-{slug(metric)}")
+    write_file(base + ".json", pio.to_json(fig))
+    write_file(base + ".html", pio.to_html(fig, include_plotlyjs="directory")) # plotly.min.js is written once next to them
+    files = [base + ".json", base + ".html"]
+    if images:
+        fig.write_image(base + ".png")
+        files.append(base + ".png")
+    return files
+
+def render_org(out_dir, tc):
+    # tc None: the employees without a TC in the extract, which prep_org_data gives the TC NULL_FILLER
+    data = shared["org"]
+    name = NO_TC if tc is None else slug(tc)
+    base = os.path.join(out_dir, "org", name)
+
+    # Managers in another TC aren't in this chart, so their reportees hang under Outsider, like in pyvis
+    graph_df = data["graph_df"][data["graph_df"]["TC"] == (NULL_FILLER if tc is None else tc)]
+    graph_df = graph_df.assign(PEM_ID=graph_df["PEM_ID"].where(graph_df["PEM_ID"].isin(graph_df.index), "Outsider"))
+    write_file(base + ".json", json.dumps(prep_graph_elements(graph_df, data["positions"])))
+
+    org_df = data["org_df"]
+    net = pyvis_explore.prep_network(org_df[org_df["TC"].isna() if tc is None else org_df["TC"] == tc], freeze=True,
+                                     layout_cache_dir=os.path.join(LAYOUT_CACHE_DIR, "pyvis", name), # Own cache, workers run side by side
+                                     cdn_resources="in_line")
+    write_file(base + ".html", pyvis_explore.offline_html(net)) # vis.js in the page, opens without a network connection
+    return [base + ".json", base + ".html"]
+
+def render_job(job):
+    # Runs in a worker. Returns (job id, seconds, files written)
+    start = time.perf_counter()
+    kind, job_id, args = job
+    files = render_covid(*args) if kind == "covid" else render_org(*args)
+    return job_id, time.perf_counter() - start, files
+
+def plan_jobs(datasets, out_dir, images):
+    # [(kind, job id, render args)] and {kind: fingerprint of its dataset}
+    jobs = []
+    fingerprints = {}
+    if "covid" in datasets:
+        cv_df = datasets["covid"]["cv_df"]
+        fingerprints["covid"] = fingerprint(cv_df)
+        for state in cv_df["State"].unique():
+            for metric in METRICS:
+                jobs.append(("covid", f"covid/{slug(state)}/{metric}", (out_dir, state, metric, images)))
+    if "org" in datasets:
+        org_df = datasets["org"]["org_df"]
+        fingerprints["org"] = fingerprint(org_df)
+        for tc in org_df["TC"].dropna().unique():
+            jobs.append(("org", f"org/{slug(tc)}", (out_dir, tc)))
+        if org_df["TC"].isna().any():
+            jobs.append(("org", f"org/{NO_TC}", (out_dir, None)))
+    return jobs, fingerprints
+
+def read_manifest(out_dir):
+    # {job id: manifest line} of the jobs finished in earlier runs into out_dir
+    path = os.path.join(out_dir, MANIFEST)
+    done = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError: # Last line of a killed run
+                    continue
+                done[entry["job"]] = entry
+    return done
+
+def prepare_out_dir(out_dir):
+    os.makedirs(os.path.join(out_dir, "covid"), exist_ok=True)
+    os.makedirs(os.path.join(out_dir, "org"), exist_ok=True)
+    plotly_js = os.path.join(out_dir, "covid", "plotly.min.js") # Referenced by every covid html, so they work offline
+    if not os.path.exists(plotly_js):
+        write_file(plotly_js, plotly.offline.get_plotlyjs())
+
+def run(covid_source, org_source, out_dir, workers=None, images=False, force=False):
+    if images and kaleido is None:
+        print("kaleido not installed, skipping static images...")
+        images = False
+    print("Loading datasets...")
+    shared.update(load_datasets(covid_source, org_source))
+    prepare_out_dir(out_dir)
+    jobs, fingerprints = plan_jobs(shared, out_dir, images)
+
+    done = {} if force else read_manifest(out_dir)
+    todo = [job for job in jobs
+            if not (job[1] in done and done[job[1]]["fingerprint"] == fingerprints[job[0]]
+                    and all(os.path.exists(path) for path in done[job[1]]["files"]))]
+    print(f"{len(jobs)} jobs, {len(jobs) - len(todo)} already done, {len(todo)} to run...")
+
+    # fork shares the prepared frames with the workers copy on write. Elsewhere they are saved once for the workers to read
+    context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else None)
+    start = time.perf_counter()
+    timings = []
+    failed = []
+    with tempfile.TemporaryDirectory(prefix="batch_render-") as saved, \
+            ProcessPoolExecutor(workers, mp_context=context, initializer=init_worker,
+                                initargs=({} if context.get_start_method() == "fork" else save_datasets(shared, saved),)) as pool, \
+            open(os.path.join(out_dir, MANIFEST), "a") as manifest:
+        futures = {pool.submit(render_job, job): job for job in todo}
+        for future in as_completed(futures):
+            kind, job_id, _ = futures[future]
+            try:
+                job_id, seconds, files = future.result()
+            except Exception as e: # One bad job doesn't stop the run, it is retried on the next one
+                print(f"FAILED {job_id}: {e!r}")
+                failed.append(job_id)
+                continue
+            timings.append((seconds, job_id))
+            print(f"{seconds:8.2f}s {job_id}")
+            manifest.write(json.dumps({"job": job_id, "fingerprint": fingerprints[kind], "seconds": round(seconds, 3),
+                                       "files": files}) + "\n")
+            manifest.flush()
+
+    elapsed = time.perf_counter() - start
+    busy = sum(seconds for seconds, _ in timings)
+    print(f"{len(timings)} jobs in {elapsed:.1f}s wall, {busy:.1f}s of work ({busy / elapsed if elapsed else 0:.1f}x parallel)")
+    for seconds, job_id in sorted(timings, reverse=True)[:5]:
+        print(f"  slowest: {seconds:8.2f}s {job_id}")
+    if failed:
+        print(f"{len(failed)} jobs failed, re-run to retry them")
+    return not failed
+
+def main():
+    parser = argparse.ArgumentParser(description="Render COVID trend figures and org charts to static files")
+    parser.add_argument("--covid", help="districts.csv path or url")
+    parser.add_argument("--org", help="VW_COMMERCIAL_BARCLAYS_INFO xlsx extract")
+    parser.add_argument("--out", default="snapshots", help="output directory")
+    parser.add_argument("--workers", type=int, default=None, help="processes, default one per core")
+    parser.add_argument("--images", action="store_true", help="also write png figures (needs kaleido)")
+    parser.add_argument("--force", action="store_true", help="re-render jobs already in the manifest")
+    args = parser.parse_args()
+    if not args.covid and not args.org:
+        parser.error("give --covid and/or --org")
+    ok = run(args.covid, args.org, args.out, args.workers, args.images, args.force)
+    raise SystemExit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+# Benchmark: bytes on the wire and serialization time of the update_graph response per graph option,
+# plain (full figure) vs downsampled vs downsampled + compact_fig, each as JSON and gzipped
+# shrink: plain JSON bytes / gzipped bytes of the variant
+# identical: the compacted figure's traces, once plotly.js applied the template to them, are the same as the plain ones
+# Usage: python bench_fig_payload.py [scale] [days]    e.g. python bench_fig_payload.py 1 560
+import gzip
+import json
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from plotly.io.json import to_json_plotly
+
+from bench_incremental_metrics import prep_input
+from downsample import downsample_fig, as_array, as_numeric
+from fig_payload import compact_fig, merged, COMPRESS_LEVEL
+from plotly_explore import calc_incremental_metrics, prep_fig, serialize_fig, unify_categories, KEY_COLS
+from synthetic_data import DISTRICTS_CSV_DAYS
+
+OPTION_FILTERS = { # One filter per option, about what each is used with
+    1: 'State=="State_01"',
+    2: 'District!="All_Districts"', # Every district, a trace each
+    3: 'District=="All_Districts" and State!="Country"',
+    4: 'State=="State_01"',
+    5: 'State=="State_01"',
+}
+METRIC = "Active_i"
+
+def payload(fig):
+    # JSON as Dash sends it, timed, and its gzipped size
+    start = time.perf_counter()
+    body = to_json_plotly(fig).encode()
+    json_s = time.perf_counter() - start
+    start = time.perf_counter()
+    zipped = gzip.compress(body, COMPRESS_LEVEL)
+    return len(body), json_s, len(zipped), time.perf_counter() - start
+
+def points(values):
+    # A per point array as a plain list: numbers as floats, dates as epoch milliseconds, nan as None
+    values = as_array(values)
+    if values.dtype.kind not in "iuf":
+        try:
+            values = as_numeric(values) // 10**6
+        except (ValueError, TypeError): # Not dates, e.g. categories
+            return values.tolist()
+    values = values.astype(np.float64)
+    return [None if np.isnan(value) else value for value in values.tolist()]
+
+def resolved(fig):
+    # The traces as plotly.js draws them: template.data defaults under each trace (cycled per type), colorway colors where
+    # a trace has none, x0/dx expanded and hovertemplates with the trace name in. What compact_fig must leave unchanged
+    template = fig["layout"].get("template", {})
+    colorway = fig["layout"].get("colorway") or template.get("layout", {}).get("colorway")
+    seen = {}
+    traces = []
+    for i, trace in enumerate(fig["data"]):
+        trace_type = trace.get("type", "scatter")
+        defaults = template.get("data", {}).get(trace_type, [{}])
+        trace = merged(defaults[seen.get(trace_type, 0) % len(defaults)], trace)
+        seen[trace_type] = seen.get(trace_type, 0) + 1
+        color_key = "marker" if trace_type == "bar" else "line"
+        if colorway and "color" not in trace.get(color_key, {}):
+            trace[color_key] = dict(trace.get(color_key, {}), color=colorway[i % len(colorway)])
+        if "x0" in trace:
+            start = np.datetime64(trace.pop("x0"), "ms").astype(np.int64)
+            trace["x"] = (start + trace.pop("dx") * np.arange(len(as_array(trace["y"])))).astype(np.float64)
+        for key in ("x", "y"):
+            if key in trace:
+                trace[key] = points(trace[key])
+        if "hovertemplate" in trace:
+            trace["hovertemplate"] = trace["hovertemplate"].replace("%{fullData.name}", str(trace.get("name")))
+        traces.append(trace)
+    return json.dumps(traces, sort_keys=True, default=str)
+
+def main():
+    scale = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else DISTRICTS_CSV_DAYS
+    cv_df = calc_incremental_metrics(pd.concat(unify_categories([prep_input(scale, days)], KEY_COLS)))
+
+    print(f"{'option':>6} {'traces':>6} {'variant':>10} {'prep_s':>7} {'json_bytes':>11} {'json_s':>7} {'gzip_bytes':>10} {'gzip_s':>7} {'shrink':>8} {'identical':>10}")
+    for option, filter in OPTION_FILTERS.items():
+        fig = serialize_fig(prep_fig(cv_df, filter, METRIC, option))
+        variants = {"plain": (fig, 0.0)}
+        start = time.perf_counter()
+        downsampled = downsample_fig(fig)
+        variants["downsample"] = (downsampled, time.perf_counter() - start)
+        start = time.perf_counter()
+        variants["compact"] = (compact_fig(downsample_fig(fig)), time.perf_counter() - start)
+        plain_bytes = None
+        for variant, (sent, prep_s) in variants.items():
+            json_bytes, json_s, gzip_bytes, gzip_s = payload(sent)
+            plain_bytes = plain_bytes or json_bytes
+            identical = resolved(sent) == resolved(downsampled) if variant == "compact" else ""
+            print(f"{option:>6} {len(fig['data']):>6} {variant:>10} {prep_s:>7.3f} {json_bytes:>11} {json_s:>7.3f} {gzip_bytes:>10} "
+                  f"{gzip_s:>7.3f} {plain_bytes / gzip_bytes:>7.1f}x {str(identical):>10}")
+
+if __name__ == "__main__":
+    main()
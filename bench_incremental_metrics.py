@@ -0,0 +1,58 @@
+# Benchmark: grouped diff in plotly_explore.calc_incremental_metrics vs the old per (State, District) loop
+# Usage: python bench_incremental_metrics.py [scales] [days]    e.g. python bench_incremental_metrics.py 1,10,100 560
+import sys
+import time
+
+import pandas as pd
+
+from plotly_explore import calc_incremental_metrics
+from synthetic_data import make_districts_df, DISTRICTS_CSV_DAYS
+
+def legacy_incremental_metrics(cv_df):
+    # The loop load_n_prep_data used to run, kept here as the reference output
+    sd_groups = cv_df.groupby(['State','District'])
+    group_list = []
+    for name, group in sd_groups:
+        num_cols = group.iloc[:,2:]
+        num_cols = num_cols.diff()
+        num_cols.insert(0,'State',name[0])
+        num_cols.insert(1,'District',name[1])
+        group_list.append(num_cols)
+    cv_df_i = pd.concat(group_list)
+    cv_df_i = cv_df_i.rename(columns={col: f"{col}_i" for col in cv_df_i.columns[2:]})
+    return pd.merge(cv_df, cv_df_i, on = ["Date","State","District"])
+
+def prep_input(scale, days):
+    # Same shape as the frame load_n_prep_data hands over to the diff step, rollup rows included
+    cv_df = make_districts_df(scale, days).set_index(["Date"])
+    cv_df['Active'] = cv_df['Confirmed'] - cv_df['Recovered'] - cv_df['Deceased']
+    state_level_sum = cv_df.groupby(['Date','State']).sum(numeric_only=True).reset_index()
+    state_level_sum["District"] = "All_Districts"
+    country_level_sum = state_level_sum.groupby(['Date']).sum(numeric_only=True).reset_index()
+    country_level_sum["State"] = "Country"
+    country_level_sum["District"] = "All_Districts"
+    rollups = pd.concat([state_level_sum, country_level_sum]).set_index(["Date"])
+    return pd.concat([cv_df, rollups[cv_df.columns]])
+
+def timed(func, cv_df):
+    start = time.perf_counter()
+    result = func(cv_df.copy())
+    return result, time.perf_counter() - start
+
+def main():
+    scales = [int(x) for x in sys.argv[1].split(",")] if len(sys.argv) > 1 else [1, 10, 100]
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else DISTRICTS_CSV_DAYS
+    print(f"{'scale':>6} {'rows':>12} {'legacy_s':>10} {'grouped_s':>10} {'speedup':>8} {'identical':>10}")
+    for scale in scales:
+        cv_df = prep_input(scale, days)
+        legacy_df, legacy_s = timed(legacy_incremental_metrics, cv_df)
+        grouped_df, grouped_s = timed(calc_incremental_metrics, cv_df)
+        try:
+            pd.testing.assert_frame_equal(legacy_df, grouped_df)
+            identical = True
+        except AssertionError:
+            identical = False
+        print(f"{scale:>6} {len(cv_df):>12} {legacy_s:>10.3f} {grouped_s:>10.3f} {legacy_s/grouped_s:>7.1f}x {str(identical):>10}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+# Benchmark: peak memory and time of plotly_explore.load_n_prep_data, streaming vs whole-file vs the old loader
+# Usage: python bench_ingestion.py [scale] [days] [chunksize]    e.g. python bench_ingestion.py 1 560 250000
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+from bench_incremental_metrics import legacy_incremental_metrics
+from plotly_explore import load_n_prep_data, CSV_CHUNKSIZE
+from synthetic_data import write_districts_csv, DISTRICTS_CSV_DAYS
+
+def legacy_load_n_prep_data(filename):
+    # The loader before chunked ingestion: default dtypes, two full-frame appends (pd.concat here, append is gone in pandas 2)
+    cv_df = pd.read_csv(filename,parse_dates=["Date"])
+    cv_df = cv_df.set_index(["Date"])
+    cv_df['Active'] = cv_df['Confirmed'] - cv_df['Recovered'] - cv_df['Deceased']
+    state_level_sum = cv_df.groupby(['Date','State']).sum(numeric_only=True).reset_index()
+    state_level_sum["District"] = "All_Districts"
+    state_level_sum = state_level_sum.set_index(["Date"])
+    cv_df = pd.concat([cv_df, state_level_sum])
+    country_level_sum = state_level_sum.groupby(['Date']).sum(numeric_only=True).reset_index()
+    country_level_sum["State"] = "Country"
+    country_level_sum["District"] = "All_Districts"
+    country_level_sum = country_level_sum.set_index(["Date"])
+    cv_df = pd.concat([cv_df, country_level_sum])
+    return legacy_incremental_metrics(cv_df)
+
+def measure(func, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+def main():
+    scale = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else DISTRICTS_CSV_DAYS
+    chunksize = int(sys.argv[3]) if len(sys.argv) > 3 else CSV_CHUNKSIZE
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = write_districts_csv(os.path.join(tmp_dir, "districts.csv"), scale, days)
+        file_mb = os.path.getsize(filename) / 2**20
+        runs = [
+            ("legacy", legacy_load_n_prep_data, (filename,)),
+            ("whole file", load_n_prep_data, (filename, None)),
+            (f"chunked {chunksize}", load_n_prep_data, (filename, chunksize)),
+        ]
+        results = []
+        for name, func, args in runs:
+            cv_df, elapsed, peak = measure(func, *args)
+            results.append((name, cv_df, elapsed, peak))
+
+    print(f"\ncsv: {file_mb:.1f} MB, scale {scale}, {days} days")
+    print(f"{'loader':>18} {'rows':>10} {'time_s':>8} {'peak_MB':>9} {'peak/csv':>9} {'frame_MB':>9}")
+    for name, cv_df, elapsed, peak in results:
+        frame_mb = cv_df.memory_usage(deep=True).sum() / 2**20
+        print(f"{name:>18} {len(cv_df):>10} {elapsed:>8.2f} {peak/2**20:>9.1f} {peak/2**20/file_mb:>8.1f}x {frame_mb:>9.1f}")
+
+    legacy_df = results[0][1]
+    for name, cv_df, _, _ in results[1:]:
+        cv_df = cv_df.astype({"State":object, "District":object})
+        # The old loader has no rolling means (<metric>_i_7d), every column it does have must match
+        pd.testing.assert_frame_equal(legacy_df, cv_df[legacy_df.columns], check_dtype=False)
+    pd.testing.assert_frame_equal(results[1][1], results[2][1], check_dtype=False) # Rolling means included
+    print("Same values from every loader")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+# Benchmark: switching the full org chart to the next extract by resending every element vs diff_org + patch_elements
+# Usage: python bench_org_diff.py [sizes] [churn]    e.g. python bench_org_diff.py 10000,100000 0.01
+# churn: share of employees added, removed, moved and restyled each between the two synthetic extracts
+# Also checks the patched elements are the same as the ones built from the new extract
+import json
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from plotly.io.json import to_json_plotly
+
+from cytoscape_explore import prep_org_data, prep_graph_elements, patch_elements, elements_patch, UPDATE_COLS, NODE_SIZE_BY
+from org_diff import diff_org, diff_summary
+from synthetic_data import make_org_df
+
+def next_extract(raw, churn, seed=1):
+    # raw with churn of its employees removed, moved to another manager and moved to another city, plus as many new ones
+    rng = np.random.default_rng(seed)
+    n = max(int(len(raw) * churn), 1)
+    raw = raw.drop(index=rng.choice(len(raw), n, replace=False)).reset_index(drop=True)
+    new = make_org_df(n, seed=seed).assign(EMP_CODE=lambda df: "NEW" + df["EMP_CODE"], EMP_NOTESID=None,
+                                           PEM_NOTESID=raw["EMP_NOTESID"].sample(n, random_state=seed).to_numpy())
+    picked = rng.choice(len(raw), 2 * n, replace=False)
+    raw.loc[picked[:n], "PEM_NOTESID"] = raw["EMP_NOTESID"].sample(n, random_state=seed + 1).to_numpy()
+    raw.loc[picked[n:], "CITY"] = "PUNE"
+    return pd.concat([raw, new], ignore_index=True)
+
+def patched(elements, replace, delete, add):
+    elements = list(elements)
+    for i, element in replace.items():
+        elements[i] = element
+    for i in delete:
+        del elements[i]
+    return elements + add
+
+def same_elements(a, b):
+    # Same elements, whatever their order
+    key = lambda elements: sorted(json.dumps(element, sort_keys=True, default=str) for element in elements)
+    return key(a) == key(b)
+
+def main():
+    sizes = [int(size) for size in (sys.argv[1] if len(sys.argv) > 1 else "10000,100000").split(",")]
+    churn = float(sys.argv[2]) if len(sys.argv) > 2 else 0.01
+
+    print(f"{'employees':>9} {'full_s':>7} {'full_bytes':>11} {'diff_s':>7} {'patch_s':>7} {'patch_bytes':>11} {'smaller':>8} {'identical':>10}  changes")
+    for size in sizes:
+        raw = make_org_df(size)
+        old_df, new_df = prep_org_data(raw), prep_org_data(next_extract(raw, churn))
+        old_elements = prep_graph_elements(old_df)
+
+        start = time.perf_counter()
+        new_elements = prep_graph_elements(new_df)
+        full_bytes = len(to_json_plotly(new_elements))
+        full_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        diff = diff_org(old_df, new_df, UPDATE_COLS + [NODE_SIZE_BY])
+        diff_s = time.perf_counter() - start
+        start = time.perf_counter()
+        changes = patch_elements(old_elements, diff, new_df, full=True)
+        patch_bytes = len(to_json_plotly(elements_patch(*changes)))
+        patch_s = time.perf_counter() - start
+
+        identical = same_elements(patched(old_elements, *changes), new_elements)
+        print(f"{size:>9} {full_s:>7.3f} {full_bytes:>11} {diff_s:>7.3f} {patch_s:>7.3f} {patch_bytes:>11} "
+              f"{full_bytes / patch_bytes:>7.1f}x {str(identical):>10}  {diff_summary(diff)}")
+
+if __name__ == "__main__":
+    main()
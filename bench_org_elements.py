@@ -0,0 +1,141 @@
+# Benchmark: vectorized cytoscape_explore.prep_org_data + prep_graph_elements vs the old itertuples/if-elif code
+# Usage: python bench_org_elements.py [sizes] [legacy_max]    e.g. python bench_org_elements.py 10000,100000,1000000 100000
+# The legacy code is only run up to legacy_max employees, it takes minutes at 1M
+import json
+import sys
+import time
+
+from cytoscape_explore import prep_org_data, prep_graph_elements, NULL_FILLER
+from synthetic_data import make_org_df
+
+def legacy_get_shape(band):
+    if band in ["D","10","09","08"]:
+        return "square"
+    elif band in ["7B","7A"]:
+        return "circle"
+    elif band in ["6G","6A","6B"]:
+        return "diamond"
+    else:
+        return "triangle"
+
+def legacy_get_color(city):
+    if city == "PUNE":
+        return "city_1"
+    elif city == "BANGALORE":
+        return "city_2"
+    elif city == "CHENNAI":
+        return "city_3"
+    elif city in ("HYDERABAD","MUMBAI","GURGAON","KOLKATA","NOIDA", "AHMEDABAD"):
+        return "city_oth"
+    else:
+        return "city_unk"
+
+def legacy_get_borderwidth(commercial_status):
+    if(commercial_status == "Onboarded_Solar"):
+        return 1
+    else:
+        return 0
+
+def legacy_get_linkcolor(tc):
+    if(tc in ["TC02 - Markets Pre Trade", "TC11 - Markets Post Trade"]):
+        return 1
+    elif (tc in ["TC03 - Personal Banking Processing", "TC04 - Retail and Business Lending", "TC09 - Wealth Processing", "TC12 - Barclays Financial Assistance"]):
+        return 2
+    elif (tc in ["TC01 - Wholesale Onboarding and Group FCO", "TC05 - Wholesale Lending", "TC36 - Corp Client Tres Svc", "TC16 - Payments and Corp Client Treas Svc", "TC17 - BX COO Shared Services"]):
+        return 3
+    elif (tc in ["TC07 - Merchant Services", "TC08 - Cards Platform", "TC15 - Servicing and Contact Centre"]):
+        return 4
+    elif (tc in ["TC13 - Secured and Unsecured Fraud"]):
+        return 5
+    elif(tc in ["TC14 - Digital"]):
+        return 6
+    elif(tc in ["TC24 - Chief Security Office", "TC32 - BI Shared Services", "TC37 - GTIS Change The Bank"]):
+        return 7
+    elif(tc in ["TC25 - Risk Finance and Treasury", "TC26 - Functions Technology"]):
+        return 8
+    else:
+        return 0
+
+def legacy_prep_org_data(df):
+    graph_df = df[['EMP_CODE','EMP_NAME','EMP_NOTESID','PEM_NOTESID','BAND','JRSS','CITY','TC','IBM_POC','COMMERCIAL_STATUS']]
+    graph_df = graph_df.set_index('EMP_CODE')
+    cols_with_nan = ['EMP_NOTESID','PEM_NOTESID','BAND','JRSS','CITY','TC','IBM_POC']
+    graph_df[cols_with_nan] = graph_df[cols_with_nan].fillna(NULL_FILLER)
+    graph_df = graph_df.sort_values(by=['TC','PEM_NOTESID'])
+    emp_id_dict = {}
+    for emp in graph_df.itertuples():
+        if (emp.EMP_NOTESID != NULL_FILLER):
+            emp_id_dict[emp.EMP_NOTESID] = emp.Index
+    soc_dict = {}
+    pem_df = graph_df[['PEM_NOTESID','EMP_NAME']]
+    pem_groups = pem_df.groupby(['PEM_NOTESID']).count()
+    for item in pem_groups.itertuples():
+        soc_dict[item.Index] = item.EMP_NAME
+    soc_dict[NULL_FILLER] = 0
+    pem_id = []
+    soc_size = []
+    for emp in graph_df.itertuples():
+        pem_id.append(emp_id_dict.get(emp.PEM_NOTESID, "Outsider"))
+        soc_size.append(soc_dict.get(emp.EMP_NOTESID,0))
+    graph_df["PEM_ID"] = pem_id
+    graph_df["SOC_SIZE"] = soc_size
+    return graph_df
+
+def legacy_prep_graph_elements(df):
+    elements = [{'data': {'id': 'Outsider', 'label': 'Outsider', 'parent':'UNKNOWN'}}]
+    for emp in df.itertuples():
+        node = {}
+        node_data = {}
+        node_data["id"] = emp.Index
+        node_data["label"] = emp.EMP_NAME
+        node_data["notes_id"] = emp.EMP_NOTESID
+        node_data["city"] = emp.CITY
+        node_data["band"] = emp.BAND
+        node_data["tc"] = emp.TC
+        node_data["jrss"] = emp.JRSS
+        node_data["soc_size"] = emp.SOC_SIZE + 20
+        node_data["parent"] = emp.TC
+        node["data"] = node_data
+        node["classes"] = f"{legacy_get_color(emp.CITY)} {legacy_get_shape(emp.BAND)} border_{legacy_get_borderwidth(emp.COMMERCIAL_STATUS)}"
+        elements.append(node)
+        edge = {}
+        edge_data = {}
+        edge_data["source"] = emp.Index
+        edge_data["target"] = emp.PEM_ID
+        edge["data"] = edge_data
+        edge["classes"] = f"link_{legacy_get_linkcolor(emp.TC)}"
+        elements.append(edge)
+    for tc in df["TC"].unique():
+        node = {}
+        node_data = {}
+        node_data["id"] = tc
+        node_data["label"] = tc
+        node["data"] = node_data
+        node["classes"] = f"parent_{legacy_get_linkcolor(tc)}"
+        elements.append(node)
+    return elements
+
+def run(prep, elements, df):
+    start = time.perf_counter()
+    graph_df = prep(df)
+    prep_s = time.perf_counter() - start
+    result = elements(graph_df)
+    return result, prep_s, time.perf_counter() - start - prep_s
+
+def main():
+    sizes = [int(x) for x in sys.argv[1].split(",")] if len(sys.argv) > 1 else [10_000, 100_000, 1_000_000]
+    legacy_max = int(sys.argv[2]) if len(sys.argv) > 2 else 100_000
+    print(f"{'employees':>10} {'legacy_prep_s':>14} {'legacy_elem_s':>14} {'prep_s':>8} {'elem_s':>8} {'speedup':>8} {'identical':>10}")
+    for size in sizes:
+        df = make_org_df(size)
+        new, prep_s, elem_s = run(prep_org_data, prep_graph_elements, df)
+        if size > legacy_max:
+            print(f"{size:>10} {'-':>14} {'-':>14} {prep_s:>8.2f} {elem_s:>8.2f} {'-':>8} {'-':>10}")
+            continue
+        old, legacy_prep_s, legacy_elem_s = run(legacy_prep_org_data, legacy_prep_graph_elements, df)
+        identical = json.dumps(old) == json.dumps(new) # json, so nan labels compare equal
+        speedup = (legacy_prep_s + legacy_elem_s) / (prep_s + elem_s)
+        print(f"{size:>10} {legacy_prep_s:>14.2f} {legacy_elem_s:>14.2f} {prep_s:>8.2f} {elem_s:>8.2f} {speedup:>7.1f}x {str(identical):>10}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+# Benchmark: figure data for (granularity, filter) answered from the rollup cube vs bucketing and filtering the daily rows per call
+# Usage: python bench_rollup_cube.py [scale] [days]    e.g. python bench_rollup_cube.py 4 560
+# Also checks the cube rows are the same as the per call ones, and times building the cube and the rolling means
+import sys
+import time
+
+import pandas as pd
+
+from bench_incremental_metrics import prep_input
+from plotly_explore import (calc_incremental_metrics, calc_rolling_means, build_rollup_cube, bucket_data, cube_level,
+                            filter_data, unify_categories, KEY_COLS, GRANULARITIES)
+from synthetic_data import DISTRICTS_CSV_DAYS
+
+FILTERS = ['District=="All_Districts" and State!="Country"', 'State=="Country"', 'State=="State_01"',
+           'District=="All_Districts" and Confirmed > 1000']
+
+def per_call(cv_df, filter, freq):
+    # What answering without a cube takes: bucket the daily rows, then filter them
+    return filter_data(cv_df if freq is None else bucket_data(cv_df, freq), filter)
+
+def from_cube(cube, filter, granularity):
+    entry = cube[(granularity, cube_level(filter))]
+    return filter_data(entry["cv_df"], filter, filter_index=entry["filter_index"])
+
+def same_rows(a, b):
+    # Same rows, whatever their order
+    flat = lambda df: df.reset_index().astype({col: str for col in KEY_COLS}).sort_values(["Date"] + KEY_COLS, ignore_index=True)
+    return flat(a).equals(flat(b))
+
+def timed(func, *args, repeat=3):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func(*args)
+    return result, (time.perf_counter() - start) / repeat
+
+def main():
+    scale = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else DISTRICTS_CSV_DAYS
+    cv_df = pd.concat(unify_categories([prep_input(scale, days)], KEY_COLS)) # Categorical keys, like load_n_prep_data
+    cv_df = calc_incremental_metrics(cv_df)
+    cv_df, rolling_s = timed(calc_rolling_means, cv_df, repeat=1)
+    cube, cube_s = timed(build_rollup_cube, cv_df, repeat=1)
+    print(f"{len(cv_df)} daily rows: rolling means {rolling_s:.2f}s, cube {cube_s:.2f}s "
+          f"({sum(len(entry['cv_df']) for entry in cube.values()) - len(cv_df)} extra rows)")
+
+    print(f"{'granularity':>11} {'level':>9} {'per_call_s':>10} {'cube_s':>8} {'speedup':>8} {'identical':>10}  filter")
+    for granularity, freq in GRANULARITIES.items():
+        for filter in FILTERS:
+            expected, per_call_s = timed(per_call, cv_df, filter, freq)
+            result, cube_s = timed(from_cube, cube, filter, granularity)
+            identical = same_rows(result, expected)
+            print(f"{granularity:>11} {cube_level(filter):>9} {per_call_s:>10.4f} {cube_s:>8.4f} {per_call_s / cube_s:>7.1f}x "
+                  f"{str(identical):>10}  {filter}")
+
+if __name__ == "__main__":
+    main()
@@ -2,170 +2,356 @@ import dash
 import dash_cytoscape as cyto
 from dash import html
 from dash import dcc
+from dash import dash_table
 import dash_bootstrap_components as dbc
-from dash.dependencies import Output, Input
+from dash.dependencies import Output, Input, State
+from dash.exceptions import PreventUpdate
 import pandas as pd  # pip install pandas
-import plotly.express as px
-import networkx as nx
+import numpy as np
 
-import webbrowser as wb
+import collections
+import gc
+import glob
+import os
+import threading
+
+from data_cache import cached_frame
+from org_layout import cached_layout_positions
+from org_hierarchy import OrgHierarchy
+from instrument import stage, add_metrics_route
+from fig_payload import add_response_compression
+from background_load import BackgroundLoad, add_health_routes, open_browser_when_ready, is_reloader_watcher
+from lru_cache import LRUCache
+from org_diff import diff_org, diff_summary, diff_table, unique_employees, UPDATE_COLS
 
 NULL_FILLER = "-"
+PRESET_LAYOUT = True # Positions worked out once on the server (org_layout.py) instead of klay in every browser
+LAZY_EXPAND = True # Start with the top level managers only, tap a node to show/hide its reportees
+NODE_SIZE_BY = "SOC_SIZE" # "SOC_SIZE" for direct reports, "SUBTREE_SIZE" for total headcount under the employee
+DATA_FILE = "data/VW_COMMERCIAL_BARCLAYS_INFO_202108061114.xlsx"
+EXTRACT_PATTERN = "data/VW_COMMERCIAL_BARCLAYS_INFO_*.xlsx" # Dated extracts, the timestamp in the name sorts them
+CHART_CACHE_SIZE = 4 # Charts of other extracts kept loaded, to compare with and switch to
+DIFF_PAGE_SIZE = 20 # Rows per page of the what changed table
+APP_URL = 'http://127.0.0.1:8050/'
+DEBUG = True
+LOAD_POLL_MS = 1000 # How often the page asks whether the chart is ready, while it is loading
+# Layouts cytoscape.js ships with. Anything else (klay, dagre, cola...) needs the extra layouts bundle, a large download
+BUILTIN_LAYOUTS = {"null", "random", "preset", "grid", "circle", "concentric", "breadthfirst", "cose"}
+
+# Class lookup tables, one entry per value that gets its own class. Anything else falls back to the *_DEFAULT
+SHAPE_BY_BAND = {**dict.fromkeys(["D","10","09","08"], "square"), **dict.fromkeys(["7B","7A"], "circle"),
+                 **dict.fromkeys(["6G","6A","6B"], "diamond")}
+SHAPE_DEFAULT = "triangle"
+
+COLOR_BY_CITY = {"PUNE": "city_1", "BANGALORE": "city_2", "CHENNAI": "city_3",
+                 **dict.fromkeys(["HYDERABAD","MUMBAI","GURGAON","KOLKATA","NOIDA", "AHMEDABAD"], "city_oth")}
+COLOR_DEFAULT = "city_unk"
+
+BORDERWIDTH_BY_STATUS = {"Onboarded_Solar": 1}
+BORDERWIDTH_DEFAULT = 0
+
+LINKCOLOR_BY_TC = {
+    **dict.fromkeys(["TC02 - Markets Pre Trade", "TC11 - Markets Post Trade"], 1),
+    **dict.fromkeys(["TC03 - Personal Banking Processing", "TC04 - Retail and Business Lending", "TC09 - Wealth Processing", "TC12 - Barclays Financial Assistance"], 2),
+    **dict.fromkeys(["TC01 - Wholesale Onboarding and Group FCO", "TC05 - Wholesale Lending", "TC36 - Corp Client Tres Svc", "TC16 - Payments and Corp Client Treas Svc", "TC17 - BX COO Shared Services"], 3),
+    **dict.fromkeys(["TC07 - Merchant Services", "TC08 - Cards Platform", "TC15 - Servicing and Contact Centre"], 4),
+    **dict.fromkeys(["TC13 - Secured and Unsecured Fraud"], 5),
+    **dict.fromkeys(["TC14 - Digital"], 6),
+    **dict.fromkeys(["TC24 - Chief Security Office", "TC32 - BI Shared Services", "TC37 - GTIS Change The Bank"], 7),
+    **dict.fromkeys(["TC25 - Risk Finance and Treasury", "TC26 - Functions Technology"], 8),
+}
+LINKCOLOR_DEFAULT = 0
 
 def get_shape(band):
     # label inside of it are: ellipse, circle, database, box, text. 
     # The ones with the label outside of it are: image, circularImage, diamond, dot, star, triangle, triangleDown, square and icon
-    if band in ["D","10","09","08"]:
-        return "square"
-    elif band in ["7B","7A"]:
-        return "circle"
-    elif band in ["6G","6A","6B"]:
-        return "diamond"
-    else:
-        return "triangle"
+    return SHAPE_BY_BAND.get(band, SHAPE_DEFAULT)
 
 def get_color(city):
-    if city == "PUNE":
-        return "city_1"
-    elif city == "BANGALORE":
-        return "city_2"
-    elif city == "CHENNAI":
-        return "city_3"
-    elif city in ("HYDERABAD","MUMBAI","GURGAON","KOLKATA","NOIDA", "AHMEDABAD"):
-        return "city_oth"
-    else:
-        return "city_unk"
+    return COLOR_BY_CITY.get(city, COLOR_DEFAULT)
 
 def get_borderwidth(commercial_status):
-    if(commercial_status == "Onboarded_Solar"):
-        return 1
-    else:
-        return 0
+    return BORDERWIDTH_BY_STATUS.get(commercial_status, BORDERWIDTH_DEFAULT)
 
 def get_linkcolor(tc):
-    if(tc in ["TC02 - Markets Pre Trade", "TC11 - Markets Post Trade"]):
-        return 1
-    elif (tc in ["TC03 - Personal Banking Processing", "TC04 - Retail and Business Lending", "TC09 - Wealth Processing", "TC12 - Barclays Financial Assistance"]):
-        return 2
-    elif (tc in ["TC01 - Wholesale Onboarding and Group FCO", "TC05 - Wholesale Lending", "TC36 - Corp Client Tres Svc", "TC16 - Payments and Corp Client Treas Svc", "TC17 - BX COO Shared Services"]):
-        return 3
-    elif (tc in ["TC07 - Merchant Services", "TC08 - Cards Platform", "TC15 - Servicing and Contact Centre"]):
-        return 4
-    elif (tc in ["TC13 - Secured and Unsecured Fraud"]):
-        return 5
-    elif(tc in ["TC14 - Digital"]):
-        return 6
-    elif(tc in ["TC24 - Chief Security Office", "TC32 - BI Shared Services", "TC37 - GTIS Change The Bank"]):
-        return 7
-    elif(tc in ["TC25 - Risk Finance and Treasury", "TC26 - Functions Technology"]):
-        return 8
-    else:
-        return 0
+    return LINKCOLOR_BY_TC.get(tc, LINKCOLOR_DEFAULT)
 
+def map_column(col, table, default):
+    # Vectorized get_* for a whole column. Through a categorical, so the table lookup runs once per distinct value
+    col = col.astype("category")
+    classes = np.array([table.get(value, default) for value in col.cat.categories] + [default], dtype=object)
+    return pd.Series(classes[col.cat.codes.to_numpy()], index=col.index) # Code -1 (nan) picks the trailing default
+
+@stage("load_and_prep_data")
 def load_and_prep_data(filename):
     df = pd.read_excel(filename,engine='openpyxl')
     # df = df.iloc[0:500,:]
-    
+    return prep_org_data(df)
+
+@stage("prep_org_data")
+def prep_org_data(df):
     graph_df = df[['EMP_CODE','EMP_NAME','EMP_NOTESID','PEM_NOTESID','BAND','JRSS','CITY','TC','IBM_POC','COMMERCIAL_STATUS']]
     graph_df = graph_df.set_index('EMP_CODE')
     cols_with_nan = ['EMP_NOTESID','PEM_NOTESID','BAND','JRSS','CITY','TC','IBM_POC']
     graph_df[cols_with_nan] = graph_df[cols_with_nan].fillna(NULL_FILLER)
     graph_df = graph_df.sort_values(by=['TC','PEM_NOTESID'])
 
-    emp_id_dict = {} # Index on EMP_NOTESID to return EMP_CODE
-    for emp in graph_df.itertuples():
-        # if not (pd.isna(emp.EMP_NOTESID)): # If the fillna was not done before pd.isna() is a good way for individual rows
-        if (emp.EMP_NOTESID != NULL_FILLER):
-            emp_id_dict[emp.EMP_NOTESID] = emp.Index
-    # print(emp_id_dict)     
-
-    soc_dict = {}
-    pem_df = graph_df[['PEM_NOTESID','EMP_NAME']]
-    pem_groups = pem_df.groupby(['PEM_NOTESID']).count()
-    for item in pem_groups.itertuples():
-        soc_dict[item.Index] = item.EMP_NAME # Here index is Notes ID and EMP_NAME is count  
-    
-    soc_dict[NULL_FILLER] = 0 # Over riding the SOC for "-" PEM
-
-    pem_id = []
-    soc_size = []
-    for emp in graph_df.itertuples():
-        pem_id.append(emp_id_dict.get(emp.PEM_NOTESID, "Outsider"))
-        soc_size.append(soc_dict.get(emp.EMP_NOTESID,0))
-    graph_df["PEM_ID"] = pem_id
-    graph_df["SOC_SIZE"] = soc_size
+    # Index on EMP_NOTESID to return EMP_CODE. If a notes id is repeated, the last employee with it wins
+    emp_ids = pd.Series(graph_df.index, index=graph_df['EMP_NOTESID'])
+    emp_ids = emp_ids[emp_ids.index != NULL_FILLER]
+    emp_ids = emp_ids[~emp_ids.index.duplicated(keep='last')]
+
+    # Span of control: number of (named) employees reporting to each notes id. Nobody reports to "-"
+    soc = graph_df.loc[graph_df['EMP_NAME'].notna(), 'PEM_NOTESID'].value_counts()
+    soc = soc.drop(NULL_FILLER, errors='ignore')
+
+    # Positions instead of Series.map for PEM_ID, so integer EMP_CODEs don't get turned into floats by the "Outsider" gaps
+    pem_pos = emp_ids.index.get_indexer(graph_df['PEM_NOTESID'])
+    graph_df["PEM_ID"] = np.where(pem_pos >= 0, emp_ids.to_numpy(dtype=object)[pem_pos], "Outsider")
+    graph_df["SOC_SIZE"] = graph_df['EMP_NOTESID'].map(soc).fillna(0).astype(np.int64)
+
+    hierarchy = OrgHierarchy(graph_df)
+    graph_df["SUBTREE_SIZE"] = hierarchy.subtree_sizes()
+    graph_df["DEPTH"] = hierarchy.depth
+    for cycle in hierarchy.cycles:
+        print(f"Reporting loop, cut at {cycle[0]}: {' -> '.join(map(str, cycle))}")
+    if hierarchy.orphan_roots:
+        print(f"{len(hierarchy.orphan_roots)} employees report to someone not in the extract (shown under Outsider)")
 
     # print(graph_df)
 
     return graph_df
 
-def prep_graph_elements(df):
-    # df = df.sort_values(by=["TC"])
-    # nxg = nx.Graph()
-    # for emp in df.itertuples():
-    #     nxg.add_node(emp.Index)
-    #     nxg.add_edge(emp.Index, emp.PEM_ID)
-    # print("Working out the graph layout...")
-    # pos_ = nx.spiral_layout(nxg, scale=3000) #goodish: shell scale=5000; spring k=10000 scale=3000; spiral scale=3000
-    # print("Gotcha!")
-    # # print(pos_)
-    
-    elements = [{'data': {'id': 'Outsider', 'label': 'Outsider', 'parent':'UNKNOWN'}}]
-    for emp in df.itertuples():
-        node = {}
-        node_data = {}
-        
-        
-        node_data["id"] = emp.Index
-        node_data["label"] = emp.EMP_NAME
-        node_data["notes_id"] = emp.EMP_NOTESID
-        node_data["city"] = emp.CITY
-        node_data["band"] = emp.BAND
-        node_data["tc"] = emp.TC
-        node_data["jrss"] = emp.JRSS
-        node_data["soc_size"] = emp.SOC_SIZE + 20
-        node_data["parent"] = emp.TC
-        node["data"] = node_data
-
-        # node_position = {}
-        # x,y = pos_[emp.Index]
-        # node_position["x"] = x
-        # node_position["y"] = y
-        # node["position"] = node_position
-
-        node["classes"] = f"{get_color(emp.CITY)} {get_shape(emp.BAND)} border_{get_borderwidth(emp.COMMERCIAL_STATUS)}"
-        elements.append(node)
-        
-        edge = {}
-        edge_data = {}
-        edge_data["source"] = emp.Index
-        edge_data["target"] = emp.PEM_ID
-        edge["data"] = edge_data
-        edge["classes"] = f"link_{get_linkcolor(emp.TC)}"
-        elements.append(edge)
-
-    for tc in df["TC"].unique():
-        node = {}
-        node_data = {}
-        node_data["id"] = tc
-        node_data["label"] = tc
-        node["data"] = node_data
-        node["classes"] = f"parent_{get_linkcolor(tc)}"
-        elements.append(node)
+def node_sizes(df):
+    if NODE_SIZE_BY == "SUBTREE_SIZE":
+        return (20 + 10 * np.log2(df["SUBTREE_SIZE"])).round().astype(np.int64) # log, or the CEO would fill the screen
+    return df["SOC_SIZE"] + 20
 
+def prep_emp_elements(df, positions=None):
+    # One node and one edge (to the manager) per employee in df
+    # positions: {str(EMP_CODE): {"x", "y"}} from org_layout.cached_layout_positions, for the 'preset' layout
+
+    # Classes worked out a column at a time, then every node and edge dict built in one pass
+    node_classes = (map_column(df["CITY"], COLOR_BY_CITY, COLOR_DEFAULT) + " "
+                    + map_column(df["BAND"], SHAPE_BY_BAND, SHAPE_DEFAULT) + " border_"
+                    + map_column(df["COMMERCIAL_STATUS"], BORDERWIDTH_BY_STATUS, BORDERWIDTH_DEFAULT).astype(str))
+    edge_classes = "link_" + map_column(df["TC"], LINKCOLOR_BY_TC, LINKCOLOR_DEFAULT).astype(str)
+
+    elements = []
+    emp_codes = df.index.tolist()
+    node_positions = [positions[str(emp_code)] for emp_code in emp_codes] if positions else [None] * len(emp_codes)
+    columns = zip(emp_codes, df["EMP_NAME"].tolist(), df["EMP_NOTESID"].tolist(), df["CITY"].tolist(),
+                  df["BAND"].tolist(), df["TC"].tolist(), df["JRSS"].tolist(), node_sizes(df).tolist(),
+                  df["PEM_ID"].tolist(), node_classes.tolist(), edge_classes.tolist(), node_positions)
+    gc_was_enabled = gc.isenabled()
+    gc.disable() # Millions of small dicts, none of them in a reference cycle. The cyclic gc would only keep rescanning them
+    try:
+        for emp_code, name, notes_id, city, band, tc, jrss, soc_size, pem_id, node_class, edge_class, position in columns:
+            node = {'data': {'id': emp_code, 'label': name, 'notes_id': notes_id, 'city': city, 'band': band,
+                             'tc': tc, 'jrss': jrss, 'soc_size': soc_size, 'parent': tc},
+                    'classes': node_class}
+            if position is not None:
+                node["position"] = position
+            elements.append(node)
+            elements.append({'data': {'source': emp_code, 'target': pem_id}, 'classes': edge_class})
+    finally:
+        if gc_was_enabled:
+            gc.enable()
     return elements
 
-def prep_dash(elements):
-    cyto.load_extra_layouts()
+def prep_outsider_element(positions=None):
+    node = {'data': {'id': 'Outsider', 'label': 'Outsider', 'parent':'UNKNOWN'}}
+    if positions:
+        node["position"] = positions["Outsider"]
+    return node
+
+def prep_tc_elements(df):
+    return [{'data': {'id': tc, 'label': tc}, 'classes': f"parent_{get_linkcolor(tc)}"} for tc in df["TC"].unique()]
+
+@stage("prep_graph_elements")
+def prep_graph_elements(df, positions=None):
+    return [prep_outsider_element(positions)] + prep_emp_elements(df, positions) + prep_tc_elements(df)
+
+def top_level(df, hierarchy):
+    # Drill down starts from the roots of hierarchy (df's OrgHierarchy): the employees under "Outsider", their manager isn't in
+    # the extract, and the member every reporting loop is cut at. Those hang under Outsider too, their manager is under them
+    return df[hierarchy.parent < 0].assign(PEM_ID="Outsider")
+
+@stage("prep_initial_elements")
+def prep_initial_elements(df, hierarchy, positions=None):
+    # Drill down mode: only the TC compound nodes and the top level managers, the rest comes in through toggle_reports
+    return [prep_outsider_element(positions)] + prep_emp_elements(top_level(df, hierarchy), positions) + prep_tc_elements(df)
+
+def element_key(element):
+    # What a page keeps of every element it shows, instead of the element: the node id, or ">" + the employee of an edge
+    data = element['data']
+    return f">{data['source']}" if 'source' in data else data['id']
+
+@stage("toggle_reports", rows=lambda changes: len(changes[1]) + len(changes[2]))
+def toggle_reports(keys, emp_id, df, hierarchy, positions=None):
+    # Shows emp_id's direct reports, or if they are already shown, hides everyone under emp_id. keys are the element_key of
+    # the elements shown, in order, so a tap doesn't send the elements themselves. Returns the changes as patch_elements does:
+    # ({}, [indexes] to delete, highest first, [elements] to add). hierarchy is df's OrgHierarchy, it answers both without walking df
+    shown = {key for key in keys if not key.startswith(">")}
+    if emp_id == "Outsider":
+        top = top_level(df, hierarchy)
+        reports, under = top.index.tolist(), hierarchy.codes.tolist()
+    elif emp_id in hierarchy.rows.index:
+        reports, under = hierarchy.direct_reports(emp_id), hierarchy.subtree(emp_id)
+    else: # A TC compound node
+        return {}, [], []
+    if not any(report in shown for report in reports):
+        new_reports = [report for report in dict.fromkeys(reports) if report not in shown]
+        new_reports = top[~top.index.duplicated()].loc[new_reports] if emp_id == "Outsider" else df.loc[new_reports]
+        print(f"Showing {len(new_reports)} reportees of {emp_id}...")
+        return {}, [], prep_emp_elements(new_reports, positions)
+
+    hidden = shown.intersection(under) - {emp_id}
+    print(f"Hiding {len(hidden)} employees under {emp_id}...")
+    delete = [i for i, key in enumerate(keys) if (key[1:] if key.startswith(">") else key) in hidden]
+    return {}, delete[::-1], []
+
+@stage("patch_elements", rows=lambda patch: len(patch[0]) + len(patch[1]) + len(patch[2]))
+def patch_elements(elements, diff, df, positions=None, full=False, hierarchy=None):
+    # What turns elements (the chart as shown, of the old extract of diff) into the chart of df (the new one), without resending
+    # the rest: ({index: element} to replace, [indexes] to delete, highest first, [elements] to add)
+    # Drill down state is kept: added or moved employees only show up under a manager whose reports are shown (any, if full),
+    # and everyone shown under an employee who disappears goes with them. Shown nodes move to their positions in df's layout
+    # hierarchy, df's OrgHierarchy, gives the top level of drill down (see top_level). Without it, the employees under Outsider
+    nodes, edges, tcs = {}, {}, {} # id -> index in elements, edges by their employee (source)
+    outsider = None
+    for i, element in enumerate(elements):
+        data = element['data']
+        if 'source' in data:
+            edges[data['source']] = i
+        elif 'parent' not in data:
+            tcs[data['id']] = i
+        elif data['id'] == 'Outsider':
+            outsider = i
+        else:
+            nodes[data['id']] = i
+    if not full and hierarchy is not None: # Every root shows under Outsider, as in top_level
+        df = df.assign(PEM_ID=df["PEM_ID"].where(hierarchy.parent >= 0, "Outsider"))
+    df = unique_employees(df)
+    manager = dict(zip(df.index.tolist(), df["PEM_ID"].tolist()))
+
+    gone = set(diff["removed"]).intersection(nodes)
+    moved = set(diff["moved"])
+    expanded = {manager[emp] for emp in nodes if emp in manager and emp not in moved} | {"Outsider"}
+    visible = lambda emp: full or (manager[emp] in expanded and (manager[emp] in nodes or manager[emp] == "Outsider"))
+    gone.update(emp for emp in moved.intersection(nodes) if not visible(emp))
+    shown_reports = {}
+    for emp in nodes:
+        if emp in manager:
+            shown_reports.setdefault(manager[emp], []).append(emp)
+    queue = list(gone)
+    for emp in queue: # Everyone shown under a hidden employee, level by level
+        for report in shown_reports.get(emp, []):
+            if report not in gone:
+                gone.add(report)
+                queue.append(report)
+
+    changed = (moved | set(diff["restyled"]) | set(diff["updated"])).intersection(nodes) - gone
+    relocated = set() # Only the position changed, the edge stays as it is
+    if positions:
+        relocated = {emp for emp, i in nodes.items()
+                     if emp not in gone and emp not in changed and elements[i].get('position') != positions[str(emp)]}
+    appear = [emp for emp in list(diff["added"]) + list(diff["moved"])
+              if emp not in nodes and visible(emp) and (full or manager[emp] not in gone)]
+
+    replace = {}
+    add = [element for element in prep_tc_elements(df) if element['data']['id'] not in tcs] # New TCs first, they hold the nodes
+    fresh = prep_emp_elements(df.loc[list(changed) + list(relocated) + appear], positions) # node, edge, node, edge...
+    for node, edge in zip(fresh[::2], fresh[1::2]):
+        emp = node['data']['id']
+        if emp in nodes:
+            replace[nodes[emp]] = node
+            if emp in relocated:
+                continue
+            if emp in edges:
+                replace[edges[emp]] = edge
+            else:
+                add.append(edge)
+        else:
+            add.extend([node, edge])
+    if positions and outsider is not None and elements[outsider].get('position') != positions["Outsider"]:
+        replace[outsider] = prep_outsider_element(positions)
+
+    new_tcs = set(df["TC"].unique())
+    delete = [i for emp in gone for i in (nodes[emp], edges.get(emp)) if i is not None]
+    delete += [i for tc, i in tcs.items() if tc not in new_tcs]
+    return replace, sorted(delete, reverse=True), add
+
+def elements_patch(replace, delete, add):
+    # patch_elements' changes as a dash.Patch, so only they go to the browser. Deletes go highest index first, so the
+    # indexes of the ones still to go don't shift. Cytoscape gets an elements diff, the viewport (zoom, pan) is left alone
+    patch = dash.Patch()
+    for i, element in replace.items():
+        patch[i] = element
+    for i in delete:
+        del patch[i]
+    patch.extend(add)
+    return patch
+
+def keys_patch(replace, delete, add):
+    # The same changes as elements_patch, for the page's element keys (see element_key)
+    return elements_patch({i: element_key(element) for i, element in replace.items()}, delete, [element_key(element) for element in add])
+
+def prep_dash(elements=None, layout=None, expand=None, load=None, extracts=None):
+    # layout: {'name': 'preset'} when the elements carry positions, klay in the browser otherwise
+    # expand, if given, is called as expand(tapped_emp_id, keys) when a node is tapped, with the element_key of every element
+    # shown, and returns the changes to them (see toggle_reports). Only those go to the browser
+    # load, if given instead of elements and expand, returns a chart (see load_chart). It runs in a background thread once
+    # app.pending.start() is called, and the chart fills in when it is done. Readiness at GET /health and /ready (background_load.py)
+    # extracts, if given with load, are the extract files offered for a what changed view against the one shown, and for
+    # switching the chart over to one of them with element patches
+    layout = layout or {'name': 'klay'} # circle, dagre & klay work fast, cose & spread work slow
+    if layout['name'] not in BUILTIN_LAYOUTS:
+        cyto.load_extra_layouts() # Only when used, every page load downloads it otherwise
+    pending = BackgroundLoad(load, "org chart") if load is not None else None
+    charts = LRUCache(CHART_CACHE_SIZE)
+    build_locks = collections.defaultdict(threading.Lock) # One per extract
+
+    def chart_for(filename):
+        # The chart a page shows, by its extract. The one loaded at startup, or another one loaded on first use
+        chart = pending.result()
+        if filename is None or filename == chart["filename"]:
+            return chart
+        with build_locks[filename]: # Pages opened at once all ask for it: one builds it, the others wait and get it from charts
+            return charts.get_or_set(filename, lambda: load_chart(filename))
+
+    diff_rows = []
+    if extracts and pending is not None:
+        diff_rows = [
+            dbc.Row([
+                dbc.Col([
+                    html.P("Compare with extract:"),
+                    dcc.Dropdown(id='extract',
+                        options=[{'label': os.path.basename(extract), 'value': extract} for extract in extracts],
+                        value=extracts[-1],
+                        clearable=False),
+                    ], width=6
+                ),
+                dbc.Col([
+                    html.Button("Apply changes to the chart", id='apply-extract', n_clicks=0),
+                    html.Div(id='diff-summary'),
+                    ], width=6
+                ),
+            ]),
+        ]
     app = dash.Dash(external_stylesheets=[dbc.themes.LUX])
-    app.layout = html.Div([
+    app.layout = html.Div(diff_rows + [
+        dcc.Store(id='chart-extract', data={'filename': None, 'previous': None}), # Extract shown in this page, and the one before
+        dcc.Store(id='chart-keys', data=[element_key(element) for element in elements or []]), # Same order as the elements
         dbc.Row([
             dbc.Col([
+                html.Div(id='load-status'),
+                dcc.Interval(id='load-poll', interval=LOAD_POLL_MS, disabled=pending is None), # Until the chart is loaded
                 cyto.Cytoscape(
                     id='org-chart',
-                    layout={'name': 'klay'}, # circle, dagre & klay work fast, cose & spread work slow
+                    layout=layout,
                     style={'width': '100%', 'height': '95vh'},
-                    elements = elements,
+                    elements = elements or [],
                     # minZoom = 0.02, maxZoom = 2,
                     stylesheet = [
                         {'selector': 'node',
@@ -233,39 +419,131 @@ def prep_dash(elements):
                     ]
                 )], width=12)
         ])
-    ])
+    ] + ([
+        dbc.Row([
+            dbc.Col(
+                dash_table.DataTable(id='diff-table',
+                    columns=[{'name': col, 'id': col} for col in ["CHANGE", "EMP_CODE", "EMP_NAME", "TC", "FIELD", "OLD", "NEW"]],
+                    data=[],
+                    page_size=DIFF_PAGE_SIZE,
+                    sort_action='native',
+                    filter_action='native'),
+                width=12
+            )
+        ])
+    ] if diff_rows else []))
+
+    def status():
+        return pending.status() if pending is not None else {"name": "org chart", "state": "ready", "ready": True}
+
+    if expand is not None or pending is not None:
+        @app.callback(
+            Output('org-chart','elements'),
+            Output('load-poll','disabled'),
+            Output('load-status','children'),
+            Output('chart-extract','data'),
+            Output('chart-keys','data'),
+            Input('org-chart','tapNodeData'),
+            Input('load-poll','n_intervals'),
+            State('chart-keys','data'),
+            State('chart-extract','data'),
+        )
+        def update_nodes(data, n_intervals, keys, shown):
+            if pending is not None and not pending.ready(): # Still loading, or failed to: the poll stops on failure
+                current = pending.status()
+                failed = current["state"] == "failed"
+                text = f"Loading org chart failed: {current['error']}" if failed else f"Loading org chart... {current.get('seconds', 0):.0f}s"
+                return dash.no_update, failed, text, dash.no_update, dash.no_update
+            if not dash.callback_context.triggered[0]["prop_id"].startswith("org-chart."): # The poll, or the page's first call
+                if pending is None:
+                    raise PreventUpdate
+                chart = pending.result()
+                return (chart["elements"], True, "", {'filename': chart["filename"], 'previous': None},
+                        [element_key(element) for element in chart["elements"]])
+            tap_expand = chart_for(shown['filename'])["expand"] if pending is not None else expand
+            if tap_expand is None or data is None or 'id' not in data:
+                raise PreventUpdate
+            changes = tap_expand(data['id'], keys)
+            if not any(changes):
+                raise PreventUpdate
+            return elements_patch(*changes), dash.no_update, dash.no_update, dash.no_update, keys_patch(*changes)
+
+    if diff_rows:
+        @app.callback(
+            Output('diff-table','data'),
+            Output('diff-summary','children'),
+            Input('extract','value'),
+            Input('chart-extract','data'),
+        )
+        def show_diff(extract, shown):
+            # What changed between the extract shown and the one picked. Once switched over, between the previous one and it
+            if shown['filename'] is None:
+                raise PreventUpdate
+            old, new = (shown['previous'], extract) if extract == shown['filename'] else (shown['filename'], extract)
+            if old is None:
+                return [], "Showing this extract"
+            old_chart, new_chart = chart_for(old), chart_for(new)
+            diff = diff_org(old_chart["df"], new_chart["df"], UPDATE_COLS + [NODE_SIZE_BY])
+            summary = f"{os.path.basename(old)} -> {os.path.basename(new)}: {diff_summary(diff)}"
+            return diff_table(diff, old_chart["df"], new_chart["df"]).to_dict("records"), summary
 
+        @app.callback(
+            Output('org-chart','elements', allow_duplicate=True),
+            Output('chart-extract','data', allow_duplicate=True),
+            Output('chart-keys','data', allow_duplicate=True),
+            Input('apply-extract','n_clicks'),
+            State('extract','value'),
+            State('chart-extract','data'),
+            State('org-chart','elements'),
+            prevent_initial_call=True,
+        )
+        def apply_extract(n_clicks, extract, shown, elements):
+            # Switches the page over to extract, sending only the elements that change
+            if shown['filename'] is None or extract == shown['filename']:
+                raise PreventUpdate
+            old_chart, new_chart = chart_for(shown['filename']), chart_for(extract)
+            diff = diff_org(old_chart["df"], new_chart["df"], UPDATE_COLS + [NODE_SIZE_BY])
+            replace, delete, add = patch_elements(elements, diff, new_chart["df"], new_chart["positions"],
+                                                  full=new_chart["expand"] is None, hierarchy=new_chart["hierarchy"])
+            print(f"Patching the chart to {extract}: {len(replace)} replaced, {len(delete)} deleted, {len(add)} added elements...")
+            return (elements_patch(replace, delete, add), {'filename': extract, 'previous': shown['filename']},
+                    keys_patch(replace, delete, add))
+
+    add_metrics_route(app.server) # Per stage timings, see instrument.py
+    add_health_routes(app.server, status)
+    add_response_compression(app.server) # Element lists compress well, they repeat the same keys and classes
+    app.pending = pending
     return app
 
-# @app.callback(
-#     Output('my-graph','figure'),
-#     Input('org-chart','tapNodeData'),
-# )
-# def update_nodes(data):
-#     if data is None:
-#         dff = df.copy()
-#         dff.loc[dff.name == 'Program Officer (Sojourner)', 'color'] = "yellow"
-#         fig = px.bar(dff, x='name', y='slaves_freed')
-#         fig.update_traces(marker={'color': dff['color']})
-#         return fig
-#     else:
-#         print(data)
-#         dff = df.copy()
-#         dff.loc[dff.name == data['label'], 'color'] = "yellow"
-#         print(dff)
-#         fig = px.bar(dff, x='name', y='slaves_freed')
-#         fig.update_traces(marker={'color': dff['color']})
-#         return fig
+def list_extracts(pattern=EXTRACT_PATTERN):
+    return sorted(glob.glob(pattern))
 
-def main():
-    filename = "data/VW_COMMERCIAL_BARCLAYS_INFO_202108061114.xlsx"
-    df = load_and_prep_data(filename)
+def load_chart(filename):
+    # Everything prep_dash needs for one extract: {"filename", "df", "hierarchy" (its OrgHierarchy), "positions",
+    # "elements" shown first, "expand" (or None)}
+    df = cached_frame(filename, load_and_prep_data)
     # print(df)
-    elements = prep_graph_elements(df)
+    hierarchy = OrgHierarchy(df) # The frame comes from the cache, the one prep_org_data built is long gone
+    positions = cached_layout_positions(df, hierarchy=hierarchy) if PRESET_LAYOUT else None
+    expand = None
+    if LAZY_EXPAND:
+        elements = prep_initial_elements(df, hierarchy, positions)
+        expand = lambda emp_id, keys: toggle_reports(keys, emp_id, df, hierarchy, positions)
+    else:
+        elements = prep_graph_elements(df, positions)
     # print(elements)
-    app = prep_dash(elements)
-    wb.open_new_tab('http://127.0.0.1:8050/')
-    app.run_server(debug=True)
+    return {"filename": filename, "df": df, "hierarchy": hierarchy, "positions": positions, "elements": elements,
+            "expand": expand}
+
+def main():
+    # Serves right away, the chart loads in the background. The tab opens once the server answers, and fills in when it is ready
+    app = prep_dash(layout={'name': 'preset'} if PRESET_LAYOUT else None, load=lambda: load_chart(DATA_FILE),
+                    extracts=list_extracts())
+    if is_reloader_watcher(DEBUG) or not DEBUG:
+        open_browser_when_ready(APP_URL) # Once, not again on every code reload
+    if not is_reloader_watcher(DEBUG):
+        app.pending.start()
+    app.run(debug=DEBUG)
 
 if __name__ == '__main__':
     # main()
@@ -0,0 +1,181 @@
+# On disk cache of prepared DataFrames, stored as uncompressed Feather (Arrow IPC) files, much faster to read back than a re-parse
+# Usage: df = cached_frame(filename, load_n_prep_data) instead of df = load_n_prep_data(filename)
+# Remote sources are only downloaded again once they changed: their ETag/Last-Modified are kept next to the entry, and
+# checked at most once every REMOTE_TTL_S (max_age)
+import hashlib
+import inspect
+import io
+import json
+import os
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+try:
+    import pyarrow as pa
+    from pyarrow import feather
+except ImportError: # pip install pyarrow, without it everything is just rebuilt from source
+    pa = None
+
+CACHE_DIR = "cache"
+CACHE_VERSION = "4" # Bump when the prep code changes the shape of what the loaders return
+REMOTE_TTL_S = 15 * 60 # A remote source checked more recently than this is taken as unchanged, without a request
+
+def is_remote(source):
+    return str(source).startswith(("http://", "https://"))
+
+def source_key(source, raw=None):
+    # Local files are keyed on their path, size and mtime, remote ones on a hash of the downloaded content
+    key = hashlib.sha1(CACHE_VERSION.encode())
+    if raw is not None:
+        key.update(raw)
+    else:
+        stat = os.stat(source)
+        key.update(f"{os.path.abspath(source)}|{stat.st_size}|{stat.st_mtime_ns}".encode())
+    return key.hexdigest()[:16]
+
+def cache_prefix(source, loader):
+    # All entries of one (source, loader) pair share a prefix, so older versions can be found and evicted
+    # The basename is there to be read by people, the hash of the full path or URL tells apart sources with the same basename
+    name = os.path.basename(str(source).rstrip("/")).replace(".", "_") or "source"
+    full_name = str(source) if is_remote(source) else os.path.abspath(source)
+    source_hash = hashlib.sha1(full_name.encode()).hexdigest()[:8]
+    loader = inspect.unwrap(loader) # The function itself, not a decorator's wrapper (e.g. instrument.stage)
+    module = os.path.splitext(os.path.basename(inspect.getfile(loader)))[0] # Not __module__, which is __main__ when run as a script
+    return f"{module}.{loader.__name__}-{name}-{source_hash}-"
+
+def read_cached(path):
+    # Read into memory, not memory-mapped: to_pandas copies the columns out of Arrow into writable pandas blocks anyway.
+    # self_destruct frees each Arrow column once converted, so the peak stays well under two copies of the frame
+    table = feather.read_table(path, memory_map=False)
+    return table.to_pandas(self_destruct=True) # Index (e.g. Date, EMP_CODE) is restored from the pandas metadata in the file
+
+def temp_path(path):
+    # New empty file next to path, to write and then os.replace onto path. Unique, so writers of the same path at once
+    # (threads or processes building the same entry) each replace it with a whole file of their own
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".", suffix=".tmp")
+    os.close(fd)
+    return tmp_path
+
+def write_cached(df, path):
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    tmp_path = temp_path(path)
+    try:
+        feather.write_feather(table, tmp_path, compression="uncompressed") # Reading back is then a plain file read, no decompression
+        os.replace(tmp_path, path) # Atomic, a reader never sees a half written file
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def read_validators(path):
+    # {"entry", "etag", "last_modified", "checked"} of the last download of a remote source, None if there wasn't any
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_validators(path, validators):
+    tmp_path = temp_path(path)
+    with open(tmp_path, "w") as f:
+        json.dump(validators, f)
+    os.replace(tmp_path, path)
+
+def download_if_changed(source, validators):
+    # Body of source, or None if the server says it is unchanged since validators (HTTP 304)
+    request = urllib.request.Request(source)
+    if validators and validators.get("etag"):
+        request.add_header("If-None-Match", validators["etag"])
+    if validators and validators.get("last_modified"):
+        request.add_header("If-Modified-Since", validators["last_modified"])
+    try:
+        with urllib.request.urlopen(request) as response:
+            print(f"Downloading {source}...")
+            return response.read(), response.headers.get("ETag"), response.headers.get("Last-Modified")
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return None, validators.get("etag"), validators.get("last_modified")
+        raise
+
+def evict_stale(cache_dir, prefix, keep):
+    for entry in os.listdir(cache_dir):
+        if entry.startswith(prefix) and entry.endswith(".feather") and entry != keep: # Not the remote.json of the source
+            print(f"Evicting stale cache entry: {entry}...")
+            try:
+                os.remove(os.path.join(cache_dir, entry))
+            except FileNotFoundError: # Evicted by another process writing the same source at the same time
+                pass
+
+def latest_entry(cache_dir, prefix, exclude):
+    # Most recently written entry of this (source, loader) pair, other than exclude
+    entries = [entry for entry in os.listdir(cache_dir)
+               if entry.startswith(prefix) and entry.endswith(".feather") and entry != exclude]
+    if not entries:
+        return None
+    return max((os.path.join(cache_dir, entry) for entry in entries), key=os.path.getmtime)
+
+def cached_frame(source, loader, cache_dir=CACHE_DIR, refresh=None, max_age=REMOTE_TTL_S):
+    # Returns loader(source), from the cache if the source hasn't changed since the entry was written
+    # If it has, and refresh is given, the previous entry is updated with refresh(previous_df, source) instead of calling loader
+    # A remote source checked less than max_age seconds ago is taken as unchanged. max_age=0 checks it now, e.g. on a refresh
+    return cached_entry(source, loader, cache_dir, refresh, max_age)[0]
+
+def cached_entry(source, loader, cache_dir=CACHE_DIR, refresh=None, max_age=REMOTE_TTL_S, known_entry=None):
+    # (frame, name of its cache entry) as cached_frame loads it. The entry is keyed on the source's content, so the same entry
+    # means the same data: if it is known_entry, the frame the caller already has, (None, entry) is returned without reading it
+    # Without pyarrow there are no entries, the entry is None and the frame always loaded
+    if pa is None:
+        print("pyarrow not installed, skipping the data cache...")
+        return loader(source), None
+
+    def cached(entry):
+        if entry == known_entry:
+            print(f"{source} unchanged, nothing to load...")
+            return None, entry
+        return read_cached(os.path.join(cache_dir, entry)), entry
+
+    os.makedirs(cache_dir, exist_ok=True)
+    prefix = cache_prefix(source, loader)
+    raw = None
+    if is_remote(source):
+        validators_path = os.path.join(cache_dir, f"{prefix}{CACHE_VERSION}.remote.json")
+        validators = read_validators(validators_path)
+        known = validators is not None and os.path.exists(os.path.join(cache_dir, validators["entry"]))
+        if known and time.time() - validators["checked"] < max_age:
+            print(f"{source} checked less than {max_age}s ago, using the cached data...")
+            return cached(validators["entry"])
+        try:
+            raw, etag, last_modified = download_if_changed(source, validators if known else None)
+        except urllib.error.URLError as e: # Offline: the last download is better than nothing
+            if not known:
+                raise
+            print(f"Could not check {source} ({e.reason}), using the cached data...")
+            return cached(validators["entry"])
+        entry = validators["entry"] if raw is None else f"{prefix}{CACHE_VERSION}-{source_key(source, raw)}.feather"
+        write_validators(validators_path, {"entry": entry, "etag": etag, "last_modified": last_modified, "checked": time.time()})
+        if raw is None:
+            print(f"{source} not modified, using the cached data...")
+    else:
+        entry = f"{prefix}{CACHE_VERSION}-{source_key(source)}.feather"
+    path = os.path.join(cache_dir, entry)
+
+    if os.path.exists(path):
+        if entry != known_entry:
+            print(f"Loading prepared data from cache: {path}...")
+        return cached(entry)
+
+    source_data = io.BytesIO(raw) if raw is not None else source
+    previous = latest_entry(cache_dir, f"{prefix}{CACHE_VERSION}-", entry) if refresh is not None else None
+    if previous is not None:
+        print(f"Refreshing prepared data from cache: {previous}...")
+        df = refresh(read_cached(previous), source_data)
+    else:
+        df = loader(source_data)
+    try:
+        write_cached(df, path)
+        print(f"Prepared data cached at: {path}")
+        evict_stale(cache_dir, prefix, entry)
+    except (pa.ArrowInvalid, pa.ArrowTypeError) as e: # e.g. a column mixing ints and strings
+        print(f"Could not cache prepared data ({e}), it will be rebuilt next time...")
+    return df, entry
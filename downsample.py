@@ -0,0 +1,95 @@
+# Server side downsampling of line traces before they are sent to the browser
+# Works on serialized figures (fig.to_plotly_json()), so it can run on figures straight out of the figure cache
+import base64
+
+import numpy as np
+import pandas as pd
+
+TRACE_POINT_BUDGET = 300 # Max points per trace after downsampling
+WEBGL_POINT_THRESHOLD = 20_000 # Above this many points in a figure, scatter traces are drawn with WebGL (scattergl)
+POINT_ARRAYS = ("x", "y", "customdata", "hovertext", "text") # Per point trace attributes, all sliced the same way
+
+def as_array(values):
+    # Newer plotly serializes numeric arrays as {'dtype': 'f8', 'bdata': <base64>}
+    if isinstance(values, dict) and "bdata" in values:
+        return np.frombuffer(base64.b64decode(values["bdata"]), dtype=values["dtype"])
+    return np.asarray(values)
+
+def as_numeric(x):
+    # Dates as int64 nanoseconds, so they can be compared with a zoom range and used in the LTTB triangle areas
+    x = np.asarray(x)
+    if np.issubdtype(x.dtype, np.datetime64) or x.dtype == object:
+        return pd.to_datetime(x).values.astype("datetime64[ns]").astype(np.int64)
+    return x.astype(np.float64)
+
+def to_x_value(value, like):
+    # A zoom range end from relayoutData (a date string for date axes) in the units of as_numeric(like)
+    if np.issubdtype(like.dtype, np.integer):
+        return pd.Timestamp(value).value
+    return float(value)
+
+def lttb(x, y, n_out):
+    # Largest Triangle Three Buckets: keeps first and last point, and from every bucket in between the point making
+    # the largest triangle with the previously kept point and the average of the next bucket. Returns kept positions
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = x.astype(np.float64)
+    y = y.astype(np.float64)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.intp) # n_out - 2 buckets between the first and last point
+    kept = np.empty(n_out, dtype=np.intp)
+    kept[0] = 0
+    kept[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + np.argmax(area)
+        kept[i + 1] = a
+    return kept
+
+def downsample_trace(trace, x_range=None, budget=TRACE_POINT_BUDGET):
+    # Copy of trace cut to x_range (plus one point either side, so lines run to the edges) and reduced to budget points
+    # (plus one nan point per gap in the data, so the line still breaks there instead of running straight across)
+    if trace.get("type") not in ("scatter", "scattergl") or "x" not in trace or "y" not in trace:
+        return trace
+    x = as_numeric(trace["x"])
+    y = as_array(trace["y"])
+    finite = np.isfinite(y.astype(np.float64))
+    keep = np.flatnonzero(finite) # LTTB can't rank nan points
+    gaps = np.flatnonzero(~finite & np.r_[True, finite[:-1]]) # First nan point of every run of them
+    if x_range is not None:
+        lo, hi = (to_x_value(value, x) for value in x_range)
+        start = max(np.searchsorted(x[keep], lo, side="left") - 1, 0)
+        end = np.searchsorted(x[keep], hi, side="right") + 1
+        keep = keep[start:end]
+    elif len(keep) <= budget:
+        return trace
+    keep = keep[lttb(x[keep], y[keep], budget)]
+    if len(keep):
+        keep = np.union1d(keep, gaps[(gaps > keep[0]) & (gaps < keep[-1])]) # Leading/trailing nans break nothing
+
+    trace = dict(trace)
+    for key in POINT_ARRAYS:
+        if key in trace and not isinstance(trace[key], str):
+            values = as_array(trace[key])
+            if len(values) == len(x):
+                trace[key] = values[keep]
+    return trace
+
+def count_points(fig):
+    # y when there is no x array, for traces placed with x0/dx (fig_payload.compact_fig)
+    return sum(len(as_array(trace["x"] if "x" in trace else trace["y"])) for trace in fig["data"] if "x" in trace or "y" in trace)
+
+def downsample_fig(fig, x_range=None, budget=TRACE_POINT_BUDGET, webgl_threshold=WEBGL_POINT_THRESHOLD):
+    # fig is a serialized figure and is not modified. Returns a new one with downsampled traces
+    if not fig:
+        return fig
+    data = [downsample_trace(trace, x_range, budget) for trace in fig["data"]]
+    fig = dict(fig, data=data)
+    if count_points(fig) > webgl_threshold:
+        fig["data"] = [dict(trace, type="scattergl") if trace.get("type") == "scatter" else trace for trace in data]
+    return fig
@@ -0,0 +1,143 @@
+# Smaller figure payloads for the Dash callback responses, on serialized figures (fig.to_plotly_json()) like downsample.py
+# compact_fig: dates as epoch milliseconds (or x0/dx when evenly spaced), y as the smallest typed array that holds it exactly,
+# default colors left to plotly.js, attributes shared by every trace of a type sent once through layout.template,
+# template.data cut to the types in use
+# add_response_compression: gzip for the JSON responses of a Flask server (Dash's app.server)
+import base64
+import gzip
+
+import numpy as np
+
+from downsample import as_array, POINT_ARRAYS
+
+COMPRESS_MIN_BYTES = 1400 # Smaller responses fit in a packet or two anyway
+COMPRESS_LEVEL = 5 # Most of the gain of 9 for a fraction of the time
+TRACE_KEEP = ("type", "name", "uid") # Never moved into the template
+
+def typed_array(values, dtype):
+    # Plotly's typed array spec, decoded by plotly.js without parsing a number per point
+    return {"dtype": dtype, "bdata": base64.b64encode(np.ascontiguousarray(values, dtype=dtype).tobytes()).decode("ascii")}
+
+def compact_values(values):
+    # Smallest exact encoding of a numeric array: int16/int32 without gaps, float32 for whole numbers under 2**24, else float64
+    values = as_array(values)
+    if values.dtype.kind not in "iuf" or not len(values):
+        return None
+    values = values.astype(np.float64)
+    finite = values[np.isfinite(values)]
+    if len(finite) and np.array_equal(finite, np.round(finite)):
+        largest = np.abs(finite).max()
+        if len(finite) == len(values):
+            return typed_array(values, "i2" if largest < 2**15 else "i4") if largest < 2**31 else typed_array(values, "f8")
+        if largest <= 2**24:
+            return typed_array(values, "f4") # nan stays nan
+    return typed_array(values, "f8")
+
+def compact_dates(values):
+    # {"x0", "dx"} for evenly spaced dates, else {"x": epoch ms as float64}. None if values aren't dates
+    values = as_array(values)
+    if values.dtype.kind != "M" or not len(values):
+        return None
+    ms = values.astype("datetime64[ms]").astype(np.int64)
+    steps = np.diff(ms)
+    if len(ms) > 1 and (steps == steps[0]).all() and steps[0] > 0:
+        return {"x0": str(values[0].astype("datetime64[ms]")), "dx": int(steps[0])}
+    return {"x": typed_array(ms, "f8")}
+
+def split_common(dicts):
+    # Attributes (also nested, like line.dash) with the same scalar value in every dict
+    common = {}
+    for key, value in dicts[0].items():
+        if key in TRACE_KEEP or key in POINT_ARRAYS or not all(key in d for d in dicts[1:]):
+            continue
+        values = [d[key] for d in dicts]
+        if all(isinstance(v, dict) for v in values):
+            nested = split_common(values)
+            if nested:
+                common[key] = nested
+        elif isinstance(value, (str, int, float, bool)) and all(type(v) is type(value) and v == value for v in values[1:]):
+            common[key] = value
+    return common
+
+def without(trace, common):
+    trace = dict(trace)
+    for key, value in common.items():
+        if isinstance(value, dict):
+            rest = without(trace[key], value)
+            if rest:
+                trace[key] = rest
+            else:
+                del trace[key]
+        else:
+            del trace[key]
+    return trace
+
+def merged(defaults, common):
+    # defaults with common on top. Nested attributes are merged, so common's marker.color keeps the template's marker.line
+    result = dict(defaults)
+    for key, value in common.items():
+        result[key] = merged(result[key], value) if isinstance(value, dict) and isinstance(result.get(key), dict) else value
+    return result
+
+def compact_fig(fig):
+    # fig is a serialized figure and is not modified. Returns a new one that draws the same, in fewer bytes
+    if not fig:
+        return fig
+    layout = dict(fig.get("layout", {}))
+    data = []
+    for trace in fig["data"]:
+        trace = dict(trace)
+        name = trace.get("name")
+        if name and "hovertemplate" in trace: # px puts the trace's own group value in every hovertemplate
+            trace["hovertemplate"] = trace["hovertemplate"].replace(f"={name}<", "=%{fullData.name}<")
+        if "x" in trace:
+            dates = compact_dates(trace["x"])
+            if dates is not None:
+                del trace["x"]
+                trace.update(dates)
+                axis = "xaxis" + trace.get("xaxis", "x")[1:] # x -> xaxis, x2 -> xaxis2
+                layout[axis] = dict(layout.get(axis, {}), type="date") # Numbers on an axis would otherwise make it linear
+        if "y" in trace:
+            trace["y"] = compact_values(trace["y"]) or trace["y"]
+        data.append(trace)
+
+    # Colors px picked in the same order plotly.js would (colorway[trace index]) are left to plotly.js
+    colorway = layout.get("colorway") or layout.get("template", {}).get("layout", {}).get("colorway")
+    color_key = lambda trace: "marker" if trace.get("type") == "bar" else "line"
+    if colorway and all(trace.get(color_key(trace), {}).get("color") == colorway[i % len(colorway)] for i, trace in enumerate(data)):
+        for trace in data:
+            trace[color_key(trace)] = {key: value for key, value in trace[color_key(trace)].items() if key != "color"}
+
+    # Per trace type: attributes every trace has in common go into the template, once
+    template = dict(layout.get("template", {}))
+    template_data = {}
+    for trace_type in dict.fromkeys(trace.get("type", "scatter") for trace in data):
+        traces = [i for i, trace in enumerate(data) if trace.get("type", "scatter") == trace_type]
+        defaults = template.get("data", {}).get(trace_type, [{}])
+        common = split_common([data[i] for i in traces]) if len(traces) > 1 and len(defaults) == 1 else {}
+        if common: # A single default is applied to every trace. Several would be cycled through, so they are left alone
+            for i in traces:
+                data[i] = without(data[i], common)
+            defaults = [merged(defaults[0], common)]
+        template_data[trace_type] = defaults
+    template["data"] = template_data # Defaults for the trace types not in the figure are of no use
+    layout["template"] = template
+    return dict(fig, data=data, layout=layout)
+
+def add_response_compression(server):
+    # gzip for JSON responses (callback outputs) of a Flask server, when the browser takes it. Stdlib only, no flask-compress
+    from flask import request
+
+    @server.after_request
+    def compress(response):
+        if (response.status_code != 200 or response.direct_passthrough or "Content-Encoding" in response.headers
+                or not response.mimetype.endswith("json") or "gzip" not in request.headers.get("Accept-Encoding", "")):
+            return response
+        body = response.get_data()
+        if len(body) < COMPRESS_MIN_BYTES:
+            return response
+        response.set_data(gzip.compress(body, COMPRESS_LEVEL))
+        response.headers["Content-Encoding"] = "gzip"
+        response.headers["Content-Length"] = str(len(response.get_data()))
+        response.vary.add("Accept-Encoding")
+        return response
@@ -0,0 +1,170 @@
+# Per stage timings for the load, prep and render steps: wall time, rows out and memory delta of every call
+# Usage: decorate a function with @stage("name"), read the numbers at /metrics (add_metrics_route) or in the log
+# INSTRUMENT_PROFILE=cprofile and/or tracemalloc (comma separated) also profiles every outermost stage:
+#   cprofile: a .prof file per call in INSTRUMENT_PROFILE_DIR (python -m pstats <file>, or snakeviz)
+#   tracemalloc: Python allocations of the stage and their peak, in the record (slows everything down noticeably)
+# INSTRUMENT_LOG=<path> appends every record to that file as a JSON line, on top of the "instrument" logger
+import collections
+import cProfile
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource # Unix only, for rss_bytes where there is no /proc
+except ImportError:
+    resource = None
+
+PROFILE = {mode.strip() for mode in os.environ.get("INSTRUMENT_PROFILE", "").lower().split(",") if mode.strip()}
+PROFILE_DIR = os.environ.get("INSTRUMENT_PROFILE_DIR", os.path.join("cache", "profiles"))
+LOG_PATH = os.environ.get("INSTRUMENT_LOG")
+RECENT_RECORDS = 200 # Latest records kept for /metrics, per process
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+MAXRSS_UNIT = 1 if sys.platform == "darwin" else 1024 # getrusage's ru_maxrss is in bytes on macOS, in KB on Linux and the BSDs
+
+logger = logging.getLogger("instrument")
+if LOG_PATH:
+    handler = logging.FileHandler(LOG_PATH)
+    handler.setFormatter(logging.Formatter("%(message)s")) # The message is the JSON record
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+def rss_bytes():
+    # Resident memory of this process. Without /proc (e.g. macOS) the peak resident memory so far, from getrusage,
+    # so a stage's delta is how much it raised the peak. None if neither is available (Windows)
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        pass
+    if resource is not None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * MAXRSS_UNIT
+    return None
+
+def count_rows(result):
+    # Rows of a DataFrame (or anything with a shape), length of a list, None for anything else
+    if hasattr(result, "shape"):
+        return result.shape[0]
+    if isinstance(result, list):
+        return len(result)
+    return None
+
+class StageMetrics:
+    def __init__(self, recent=RECENT_RECORDS):
+        self.recent = collections.deque(maxlen=recent)
+        self.totals = {} # stage -> calls, errors, wall_s, max_s, rows
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        with self._lock:
+            self.recent.append(record)
+            total = self.totals.setdefault(record["stage"], {"calls": 0, "errors": 0, "wall_s": 0.0, "max_s": 0.0, "rows": 0})
+            total["calls"] += 1
+            total["errors"] += "error" in record
+            total["wall_s"] += record["wall_s"]
+            total["max_s"] = max(total["max_s"], record["wall_s"])
+            total["rows"] += record["rows"] or 0
+
+    def snapshot(self):
+        with self._lock:
+            stages = {name: dict(total, mean_s=total["wall_s"] / total["calls"]) for name, total in self.totals.items()}
+            return {"pid": os.getpid(), "profile": sorted(PROFILE), "stages": stages, "recent": list(self.recent)}
+
+    def clear(self):
+        with self._lock:
+            self.recent.clear()
+            self.totals.clear()
+
+metrics = StageMetrics()
+local = threading.local() # Stack of the stages running in this thread, to tell nested ones from outermost ones
+
+def row_count(name, rows, result):
+    # rows(result), None if it fails: a broken row count is logged, it never fails the call it measures
+    try:
+        return rows(result)
+    except Exception:
+        logger.exception(f"[{name}] counting rows failed")
+        return None
+
+def finish_record(name, record, profiler):
+    # Profile dump, /metrics, log and console line of a finished call
+    if profiler is not None:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        record["profile"] = os.path.join(PROFILE_DIR, f"{name}-{int(record['start'] * 1000)}-{os.getpid()}.prof")
+        profiler.dump_stats(record["profile"])
+    metrics.add(record)
+    logger.info(json.dumps(record))
+    print(f"[{name}] {record['wall_s']:.3f}s" + (f", {record['rows']} rows" if record["rows"] is not None else "")
+          + (f", {record['rss_delta_bytes'] / 1e6:+.1f} MB" if record["rss_delta_bytes"] is not None else ""))
+
+def stage(name, rows=count_rows):
+    # Decorator recording every call of the function as stage name. rows(result) gives the row count for the record
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            stack = local.__dict__.setdefault("stack", [])
+            outermost = not stack
+            record = {"stage": name, "parent": stack[-1] if stack else None, "start": time.time()}
+            profiler = cProfile.Profile() if outermost and "cprofile" in PROFILE else None
+            traced = outermost and "tracemalloc" in PROFILE
+            if traced:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                tracemalloc.reset_peak()
+                traced_before = tracemalloc.get_traced_memory()[0]
+            rss_before = rss_bytes()
+
+            stack.append(name)
+            start = time.perf_counter()
+            try:
+                if profiler is not None:
+                    profiler.enable()
+                result = func(*args, **kwargs)
+            except BaseException as e: # Recorded (e.g. PreventUpdate out of a callback), then raised as usual
+                record["error"] = type(e).__name__
+                raise
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+                record["wall_s"] = round(time.perf_counter() - start, 6)
+                stack.pop()
+                rss_after = rss_bytes()
+                record["rss_delta_bytes"] = rss_after - rss_before if rss_before is not None and rss_after is not None else None
+                if traced:
+                    current, peak = tracemalloc.get_traced_memory()
+                    record["traced_delta_bytes"] = current - traced_before
+                    record["traced_peak_bytes"] = peak - traced_before
+                if "error" in record:
+                    record["rows"] = None
+                    finish_record(name, record, profiler)
+            record["rows"] = row_count(name, rows, result) # Only once the call returned, outside the finally
+            finish_record(name, record, profiler)
+            return result
+        return wrapper
+    return decorate
+
+def prometheus_text(snapshot):
+    # The per stage totals in the Prometheus text format
+    lines = []
+    for metric, key, kind in [("stage_calls_total", "calls", "counter"), ("stage_errors_total", "errors", "counter"),
+                              ("stage_seconds_total", "wall_s", "counter"), ("stage_seconds_max", "max_s", "gauge"),
+                              ("stage_rows_total", "rows", "counter")]:
+        lines.append(f"# TYPE {metric} {kind}")
+        lines.extend(f'{metric}{{stage="{name}"}} {total[key]}' for name, total in snapshot["stages"].items())
+    return "\n".join(lines) + "\n"
+
+def add_metrics_route(server):
+    # GET /metrics: JSON snapshot of this process. /metrics?format=prometheus for the totals only, for scraping
+    from flask import request, Response
+
+    @server.route("/metrics")
+    def stage_metrics():
+        snapshot = metrics.snapshot()
+        if request.args.get("format") == "prometheus":
+            return Response(prometheus_text(snapshot), mimetype="text/plain")
+        return snapshot
@@ -0,0 +1,48 @@
+# Bounded, thread-safe LRU cache with hit/miss/eviction counters, shared by the Dash callbacks
+from collections import OrderedDict
+import threading
+
+class LRUCache:
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict() # Oldest first, so popitem(last=False) evicts the least recently used
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_set(self, key, func):
+        # func is called outside the lock, so a slow build doesn't block hits on other keys
+        # Two callers missing the same key at once may both build it, the last one wins
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = func()
+            self.set(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._items), "maxsize": self.maxsize,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
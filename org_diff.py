@@ -0,0 +1,94 @@
+# What changed between two extracts of the org chart, on frames prepared by cytoscape_explore.prep_org_data (EMP_CODE index)
+# diff_org: EMP_CODEs added, removed, moved (new PEM_ID), restyled (CITY, BAND, TC or COMMERCIAL_STATUS changed) and updated
+# (anything else a chart node shows changed, e.g. name or span of control). An employee can be moved and restyled at once
+# diff_table: the same as one row per change, with the old and new values, for people to read
+# Usage: python org_diff.py <old extract.xlsx> <new extract.xlsx> [changes.csv]
+import sys
+
+import pandas as pd
+
+from instrument import stage
+
+MOVE_COL = "PEM_ID"
+RESTYLE_COLS = ["CITY", "BAND", "TC", "COMMERCIAL_STATUS"] # Node classes (color, shape, border) and the TC it sits in
+UPDATE_COLS = ["EMP_NAME", "EMP_NOTESID", "JRSS", "SOC_SIZE"] # Node data that doesn't change how it looks
+CHANGES = ["added", "removed", "moved", "restyled", "updated"]
+
+def unique_employees(df):
+    # An EMP_CODE repeated in an extract is one node in the chart, the first row wins
+    return df[~df.index.duplicated(keep="first")]
+
+def changed(old, new):
+    # Elementwise, True where the values differ. Missing on both sides (nan != nan) is no change
+    differs = old != new
+    candidates = differs.nonzero() # Few, so isna only runs on these
+    differs[candidates] = ~(pd.isna(old[candidates]) & pd.isna(new[candidates]))
+    return differs
+
+@stage("diff_org", rows=lambda diff: sum(len(diff[change]) for change in CHANGES))
+def diff_org(old_df, new_df, update_cols=UPDATE_COLS):
+    # {change: Index of EMP_CODEs} for every CHANGES, plus "fields": {EMP_CODE: changed columns} of the employees in both
+    old_df, new_df = unique_employees(old_df), unique_employees(new_df)
+    common = old_df.index.intersection(new_df.index, sort=False)
+    cols = list(dict.fromkeys([MOVE_COL] + RESTYLE_COLS + list(update_cols)))
+    # Rows of common looked up once, then every column compared as an object array (no .loc per column)
+    old_values = old_df[cols].to_numpy(dtype=object)[old_df.index.get_indexer(common)]
+    new_values = new_df[cols].to_numpy(dtype=object)[new_df.index.get_indexer(common)]
+    differs = pd.DataFrame(changed(old_values, new_values), index=common, columns=cols)
+    differs = differs[differs.any(axis=1)]
+    return {
+        "added": new_df.index.difference(old_df.index, sort=False),
+        "removed": old_df.index.difference(new_df.index, sort=False),
+        "moved": differs.index[differs[MOVE_COL].to_numpy()],
+        "restyled": differs.index[differs[RESTYLE_COLS].any(axis=1).to_numpy()],
+        "updated": differs.index[~differs[[MOVE_COL] + RESTYLE_COLS].any(axis=1).to_numpy()],
+        "fields": {emp_code: [col for col, flag in zip(cols, flags) if flag] for emp_code, flags in zip(differs.index, differs.to_numpy())},
+    }
+
+def diff_summary(diff):
+    return ", ".join(f"{len(diff[change])} {change}" for change in CHANGES)
+
+def manager_label(df, pem_id):
+    if pem_id in df.index:
+        return f"{df.at[pem_id, 'EMP_NAME']} ({pem_id})"
+    return str(pem_id) # Outsider
+
+@stage("diff_table")
+def diff_table(diff, old_df, new_df):
+    # One row per change: CHANGE, EMP_CODE, EMP_NAME, TC, FIELD, OLD, NEW. Managers shown by name, values as text
+    old_df, new_df = unique_employees(old_df), unique_employees(new_df)
+    rows = []
+    for change, df in [("added", new_df), ("removed", old_df)]:
+        for emp_code in diff[change]:
+            rows.append({"CHANGE": change, "EMP_CODE": emp_code, "EMP_NAME": df.at[emp_code, "EMP_NAME"], "TC": df.at[emp_code, "TC"],
+                         "FIELD": MOVE_COL, "OLD": "" if change == "added" else manager_label(old_df, old_df.at[emp_code, MOVE_COL]),
+                         "NEW": "" if change == "removed" else manager_label(new_df, new_df.at[emp_code, MOVE_COL])})
+    for emp_code, cols in diff["fields"].items():
+        for col in cols:
+            old, new = old_df.at[emp_code, col], new_df.at[emp_code, col]
+            if col == MOVE_COL:
+                change, old, new = "moved", manager_label(old_df, old), manager_label(new_df, new)
+            else:
+                change = "restyled" if col in RESTYLE_COLS else "updated"
+            rows.append({"CHANGE": change, "EMP_CODE": emp_code, "EMP_NAME": new_df.at[emp_code, "EMP_NAME"],
+                         "TC": new_df.at[emp_code, "TC"], "FIELD": col,
+                         "OLD": "" if pd.isna(old) else str(old), "NEW": "" if pd.isna(new) else str(new)})
+    table = pd.DataFrame(rows, columns=["CHANGE", "EMP_CODE", "EMP_NAME", "TC", "FIELD", "OLD", "NEW"])
+    table["CHANGE"] = pd.Categorical(table["CHANGE"], categories=CHANGES)
+    return table.sort_values(["CHANGE", "TC", "EMP_CODE"], kind="stable", ignore_index=True)
+
+def main():
+    from cytoscape_explore import load_and_prep_data # Not at the top, cytoscape_explore imports this module
+    from data_cache import cached_frame
+    old_df, new_df = (cached_frame(filename, load_and_prep_data) for filename in sys.argv[1:3])
+    diff = diff_org(old_df, new_df)
+    print(f"{sys.argv[1]} -> {sys.argv[2]}: {diff_summary(diff)}")
+    table = diff_table(diff, old_df, new_df)
+    if len(sys.argv) > 3:
+        table.to_csv(sys.argv[3], index=False)
+        print(f"{len(table)} changes written to {sys.argv[3]}")
+    else:
+        print(table.to_string(index=False))
+
+if __name__ == "__main__":
+    main()
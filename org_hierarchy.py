@@ -0,0 +1,131 @@
+# Array backed reporting tree of the org chart, built once from EMP_CODE (the index) and PEM_ID of the prepared frame
+# Employees are numbered by row. Per employee: parent row, depth, subtree size and Euler tour (preorder) number.
+# Children are stored CSR style: children[child_offsets[i]:child_offsets[i + 1]] are the direct reports of row i
+import numpy as np
+import pandas as pd
+
+NULL_FILLER = "-" # Same as cytoscape_explore, a PEM_NOTESID of "-" means no manager at all
+
+def level_children(child_offsets, children, frontier):
+    # Direct reports of every row in frontier, grouped by manager in frontier order, without a Python loop
+    starts = child_offsets[frontier]
+    counts = child_offsets[frontier + 1] - starts
+    group_starts = np.cumsum(counts) - counts
+    return children[np.repeat(starts - group_starts, counts) + np.arange(counts.sum())], counts
+
+def csr_children(parent):
+    # Rows sorted by parent (stable, so reports stay in frame order), plus where each parent's run starts
+    has_parent = parent >= 0
+    child_rows = np.flatnonzero(has_parent)
+    children = child_rows[np.argsort(parent[has_parent], kind="stable")]
+    child_offsets = np.zeros(len(parent) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(parent[has_parent], minlength=len(parent)), out=child_offsets[1:])
+    return child_offsets, children
+
+def bfs_levels(parent, child_offsets, children):
+    levels = [np.flatnonzero(parent < 0)]
+    while len(levels[-1]):
+        levels.append(level_children(child_offsets, children, levels[-1])[0])
+    return levels[:-1]
+
+def find_cycles(parent, reached):
+    # Rows never reached from a root report in a loop (or hang under one). Returns the loops, as lists of rows
+    cycles = []
+    seen = reached.copy()
+    for start in np.flatnonzero(~reached):
+        path = {}
+        row = start
+        while not seen[row]:
+            seen[row] = True
+            path[row] = len(path)
+            row = parent[row]
+        if row in path: # Came back onto this walk, so it is a new loop
+            cycles.append(list(path)[path[row]:])
+    return cycles
+
+class OrgHierarchy:
+    def __init__(self, df):
+        self.codes = df.index.to_numpy()
+        n = len(self.codes)
+        rows = pd.Series(np.arange(n), index=df.index)
+        self.rows = rows[~rows.index.duplicated()] # EMP_CODE -> row
+        parent = self.rows.reindex(df["PEM_ID"]).fillna(-1).to_numpy(np.int64) # "Outsider" isn't a row, so -1
+
+        # Reporting loops are cut at their first row, which then counts as a root
+        child_offsets, children = csr_children(parent)
+        reached = np.zeros(n, dtype=bool)
+        for level in bfs_levels(parent, child_offsets, children):
+            reached[level] = True
+        cycle_rows = find_cycles(parent, reached)
+        self.cycles = [self.codes[cycle].tolist() for cycle in cycle_rows]
+        if cycle_rows:
+            parent[[cycle[0] for cycle in cycle_rows]] = -1
+            child_offsets, children = csr_children(parent)
+        self.parent, self.child_offsets, self.children = parent, child_offsets, children
+
+        # Depth top down, subtree size bottom up, then preorder numbers top down from the sizes of earlier siblings
+        levels = bfs_levels(parent, child_offsets, children)
+        self.depth = np.zeros(n, dtype=np.int64)
+        for depth, level in enumerate(levels):
+            self.depth[level] = depth
+        self.size = np.ones(n, dtype=np.int64)
+        for level in reversed(levels[1:]):
+            np.add.at(self.size, parent[level], self.size[level])
+        self.tin = np.zeros(n, dtype=np.int64)
+        roots = levels[0] if levels else np.array([], dtype=np.int64)
+        self.tin[roots] = np.cumsum(self.size[roots]) - self.size[roots]
+        for level in levels[:-1]:
+            kids, counts = level_children(child_offsets, children, level)
+            before = np.cumsum(self.size[kids]) - self.size[kids] # Sizes of all earlier kids in this level...
+            nonempty = counts > 0
+            first_kid = (np.cumsum(counts) - counts)[nonempty]
+            group_start = np.repeat(before[first_kid], counts[nonempty]) # ...less those of other managers' kids
+            self.tin[kids] = np.repeat(self.tin[level], counts) + 1 + before - group_start
+        self.euler = np.empty(n, dtype=np.int64)
+        self.euler[self.tin] = np.arange(n) # Row at each preorder number, so a subtree is one slice
+
+        # Roots whose PEM_NOTESID was filled in but isn't anyone in the extract: chains hanging off an unknown manager
+        # Frames without PEM_NOTESID (e.g. pyvis' network data, only PEM_ID) can't tell, so have none
+        self.orphan_roots = []
+        if "PEM_NOTESID" in df:
+            has_manager_id = (df["PEM_NOTESID"] != NULL_FILLER).to_numpy()
+            orphans = roots[has_manager_id[roots] & np.isin(roots, [cycle[0] for cycle in cycle_rows], invert=True)]
+            self.orphan_roots = self.codes[orphans].tolist()
+
+    def row(self, emp):
+        return self.rows[emp]
+
+    def subtree_size(self, emp):
+        # Headcount under emp, emp included. O(1)
+        return int(self.size[self.row(emp)])
+
+    def depth_of(self, emp):
+        # Reporting levels above emp, 0 for a top level manager. O(1)
+        return int(self.depth[self.row(emp)])
+
+    def is_under(self, emp, manager):
+        # True if emp reports to manager directly or indirectly. O(1)
+        row, top = self.row(emp), self.row(manager)
+        return bool(self.tin[top] < self.tin[row] < self.tin[top] + self.size[top])
+
+    def path_to_root(self, emp):
+        # emp, their manager, their manager's manager... up to the top. O(depth)
+        path = []
+        row = self.row(emp)
+        while row >= 0:
+            path.append(self.codes[row])
+            row = self.parent[row]
+        return path
+
+    def direct_reports(self, emp):
+        row = self.row(emp)
+        return self.codes[self.children[self.child_offsets[row]:self.child_offsets[row + 1]]].tolist()
+
+    def subtree(self, emp):
+        # Everyone under emp (emp first), in preorder. O(subtree size)
+        row = self.row(emp)
+        return self.codes[self.euler[self.tin[row]:self.tin[row] + self.size[row]]].tolist()
+
+    def subtree_sizes(self):
+        # Subtree size per row of the frame it was built from, e.g. to size nodes by total headcount
+        return self.size.copy()
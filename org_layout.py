@@ -0,0 +1,281 @@
+# Server side positions for the org chart, so the browser can use the 'preset' layout instead of running klay on every load
+# Every TC is laid out as a block of trees (someone whose manager is in another TC, or an Outsider, starts a tree in their own
+# TC), blocks side by side. When the extract is reloaded, everyone still under the same manager (all the way up) keeps their
+# coordinates: only new and moved subtrees are laid out, in the free space of their TC next to their manager
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from data_cache import temp_path
+from instrument import stage
+from org_hierarchy import OrgHierarchy
+
+LAYOUT_CACHE_DIR = "cache"
+LEVEL_HEIGHT = 150 # Vertical distance between reporting levels
+NODE_WIDTH = 120 # Horizontal space for one node
+TC_GAP = 600 # Extra space between TC blocks
+TC_SLACK = 0.05 # Room left right of every TC, as a share of its width, for the people a reload adds to it
+ROOT = "ROOT" # Virtual root above the TC blocks, never drawn
+RELAYOUT_MIN_KEPT = 0.5 # Below this share of nodes keeping their place, the previous layout is ignored and the org laid out fresh
+SEARCH_CHUNK = 256 # Nodes of a row looked at at once for free space
+LAYOUT_CACHE_PREFIX = "org_layout2-"
+LAYOUT_CACHE_KEEP = 8 # Layouts kept in the cache, least recently used evicted first, so switching between extracts reuses theirs
+
+def tc_key(tc):
+    return f"TC::{tc}"
+
+def build_layout_tree(df, hierarchy):
+    # children[key] in df order, from hierarchy's reporting lines (so reporting loops are cut where OrgHierarchy cuts them).
+    # Someone whose manager is in another TC, or who has none in the extract, starts a tree in their own TC. Employee keys
+    # are str(EMP_CODE), so they can be used as json keys in the cache. A repeated EMP_CODE is one node, the first row wins
+    keys = [str(emp_code) for emp_code in hierarchy.codes]
+    tcs = df["TC"].to_numpy(dtype=object)
+    parent = hierarchy.parent
+    same_tc = (parent >= 0) & (tcs[np.maximum(parent, 0)] == tcs)
+    first = ~df.index.duplicated()
+
+    children = {ROOT: []}
+    for tc in df["TC"].unique():
+        children[ROOT].append(tc_key(tc))
+        children[tc_key(tc)] = []
+    for row in np.flatnonzero(first).tolist():
+        children[keys[row]] = []
+    for row in np.flatnonzero(first).tolist():
+        children[keys[parent[row]] if same_tc[row] else tc_key(tcs[row])].append(keys[row])
+    return children
+
+def walk(children, start=ROOT):
+    # Breadth first order, parents before their children
+    order = [start]
+    for key in order:
+        order.extend(children[key])
+    return order
+
+def structure_hash(children):
+    # The same for the same reporting lines, whatever the row order
+    lines = sorted(f"{kid}>{key}" for key, kids in children.items() for kid in kids)
+    return hashlib.sha1("\n".join(lines).encode()).hexdigest()[:16]
+
+def tidy_layout(children, top, left=0):
+    # Fresh layout of top's subtree from left: {key: x}. Subtrees side by side, each node centred over its reports
+    order = walk(children, top)
+    widths = {}
+    for key in reversed(order):
+        widths[key] = max(sum(widths[kid] for kid in children[key]), NODE_WIDTH)
+        if key.startswith(tc_key("")):
+            widths[key] += TC_GAP + int(widths[key] * TC_SLACK)
+    lefts = {top: left}
+    x_of = {}
+    for key in order:
+        offset = lefts[key]
+        for kid in children[key]:
+            lefts[kid] = offset
+            offset += widths[kid]
+        x_of[key] = lefts[key] + widths[key] / 2
+    return order, x_of
+
+def free_at(cells, start, width, step):
+    # Nearest left edge from start, going right (step 1) or left (step -1), of a free [x, x + width) in a row
+    # (cells: sorted numpy array of the left edges of its nodes). Looks at SEARCH_CHUNK nodes at a time
+    if step > 0:
+        i = np.searchsorted(cells, start - NODE_WIDTH, side="right") # Nodes left of here end before start
+        while i < len(cells):
+            chunk = cells[i:i + SEARCH_CHUNK]
+            xs = np.maximum(np.concatenate(([start], chunk[:-1] + NODE_WIDTH)), start)
+            fits = np.flatnonzero(xs + width <= chunk)
+            if len(fits):
+                return xs[fits[0]]
+            start, i = max(start, chunk[-1] + NODE_WIDTH), i + SEARCH_CHUNK
+        return start
+    j = np.searchsorted(cells, start + width, side="left") # Nodes right of here start after the span
+    while j > 0:
+        chunk = cells[max(j - SEARCH_CHUNK, 0):j]
+        xs = np.minimum(np.concatenate((chunk[1:], [start + width])) - width, start)
+        fits = np.flatnonzero(xs >= chunk + NODE_WIDTH)
+        if len(fits):
+            return xs[fits[-1]]
+        start, j = min(start, chunk[0] - width), j - SEARCH_CHUNK
+    return start
+
+def find_offset(rows, profile, zones, offset, step):
+    # Nearest offset from offset, going right (step 1) or left (step -1), where every row of profile ({depth: [lo, hi]}
+    # relative to the offset) is free in rows ({depth: cells}) and the span is clear of zones (the other TCs). None if
+    # that means going past a zone
+    span_lo = min(lo for lo, hi in profile.values())
+    span_hi = max(hi for lo, hi in profile.values())
+    while True:
+        for zone_lo, zone_hi in zones:
+            if offset + span_lo < zone_hi and offset + span_hi > zone_lo:
+                if (zone_lo + zone_hi > 2 * offset + span_lo + span_hi) == (step > 0): # In the way
+                    return None
+                offset = zone_hi - span_lo if step > 0 else zone_lo - span_hi
+        moved = False
+        for depth, (lo, hi) in profile.items():
+            cells = rows.get(depth)
+            x = offset + lo if cells is None else free_at(cells, offset + lo, hi - lo, step)
+            if x != offset + lo:
+                offset, moved = x - lo, True
+        if not moved:
+            return offset
+
+def occupy(rows, zones, depth, left, tc):
+    # Adds a node to rows ({depth: sorted numpy array of the left edges of its nodes}) and zones ({TC: [left, right] of its
+    # nodes})
+    cells = rows.get(depth, np.empty(0))
+    i = cells.searchsorted(left)
+    rows[depth] = np.concatenate((cells[:i], [left], cells[i:]))
+    zone = zones.setdefault(tc, [left, left + NODE_WIDTH])
+    zone[0], zone[1] = min(zone[0], left), max(zone[1], left + NODE_WIDTH)
+
+def occupied(x, depths, tcs):
+    # rows and zones (see occupy) of all the nodes placed in x at once
+    placed = ~np.isnan(x) & (depths >= 2)
+    lefts, depths, tcs = x[placed] - NODE_WIDTH / 2, depths[placed], tcs[placed]
+    by_depth = np.lexsort((lefts, depths))
+    bounds = np.flatnonzero(np.diff(depths[by_depth])) + 1
+    rows = {int(row[0]): cells for row, cells in zip(np.split(depths[by_depth], bounds), np.split(lefts[by_depth], bounds))}
+    zones = {}
+    for tc in np.unique(tcs).tolist():
+        ours = lefts[tcs == tc]
+        zones[tc] = [ours.min(), ours.max() + NODE_WIDTH]
+    return rows, zones
+
+def relayout(children, order, depths, parents, previous):
+    # x of every key of order (numpy, nan for ROOT and TC compound nodes). Nodes still under the same parent, all the way
+    # up, keep their previous x (see compute_layout) whether their reports changed or not. New and moved subtrees are laid
+    # out fresh and put in the nearest free space of their TC, next to their manager. None if too little of previous is kept
+    index = pd.Index(order)
+    position = dict(zip(order, range(len(order))))
+    parent = index.get_indexer(parents) # ROOT is its own parent
+    prev = pd.Index(previous["key"]).get_indexer(order)
+    prev_parents = np.array(previous["parent"] + [ROOT], dtype=object)[prev] # prev is -1 for new keys
+    same = (prev >= 0) & (prev_parents == np.array(parents, dtype=object))
+    x = np.where(same, np.array(previous["x"] + [None], dtype=float)[prev], np.nan)
+
+    # Breadth first, so one depth after the other: a level at a time, parents first
+    anchored = np.zeros(len(order), dtype=bool) # Same parent, all the way up
+    anchored[0] = True
+    tcs = np.arange(len(order)) # TC of every node, as the position of its TC compound node in order
+    levels = np.searchsorted(depths, np.arange(depths[-1] + 2))
+    for depth in range(1, depths[-1] + 1):
+        level = slice(levels[depth], levels[depth + 1])
+        anchored[level] = same[level] & anchored[parent[level]]
+        if depth > 1:
+            tcs[level] = tcs[parent[level]]
+    if anchored.mean() < RELAYOUT_MIN_KEPT:
+        return None
+    x[~anchored] = np.nan
+    rows, zones = occupied(x, depths, tcs)
+
+    for top in np.flatnonzero(~anchored & anchored[parent]).tolist(): # Tops of the new and moved subtrees, parents first
+        block_order, block_x = tidy_layout(children, order[top])
+        block = [(position[key], block_x[key]) for key in block_order if depths[position[key]] >= 2]
+        if not block: # A TC with nobody in it
+            continue
+        profile = {} # {depth: [left, right]} of the subtree's nodes, relative to where it goes
+        for i, block_x in block:
+            row = profile.setdefault(int(depths[i]), [block_x - NODE_WIDTH / 2, block_x + NODE_WIDTH / 2])
+            row[0], row[1] = min(row[0], block_x - NODE_WIDTH / 2), max(row[1], block_x + NODE_WIDTH / 2)
+        span_lo = min(lo for lo, hi in profile.values())
+        span_hi = max(hi for lo, hi in profile.values())
+        tc = int(tcs[top])
+        if depths[top] > 2: # Under its manager
+            offset = x[parent[top]] - block[0][1]
+        elif tc in zones: # A new tree of its TC, at the right end of the TC
+            offset = zones[tc][1] - span_lo
+        else: # A new TC, right of the others
+            offset = max((zone[1] + TC_GAP for zone in zones.values()), default=0) - span_lo
+
+        others = [[zone[0] - TC_GAP / 2, zone[1] + TC_GAP / 2] for other, zone in zones.items() if other != tc]
+        right = find_offset(rows, profile, others, offset, 1)
+        left = find_offset(rows, profile, others, offset, -1) if right != offset else None
+        found = [found for found in (right, left) if found is not None]
+        if found:
+            offset = min(found, key=lambda found: abs(found - offset))
+        else: # No room left in the TC: it grows to the right, the TCs right of it move over to leave it room again
+            offset = zones[tc][1] - span_lo
+            pushed = [other for other, zone in zones.items() if other != tc and zone[0] >= zones[tc][1]]
+            shift = offset + span_hi + TC_GAP + int((zones[tc][1] - zones[tc][0]) * TC_SLACK) - \
+                    min((zones[other][0] for other in pushed), default=np.inf)
+            if shift > 0:
+                print(f"Making room for {order[top]} in {order[tc]}, moving {len(pushed)} TCs right of it by {shift}...")
+                x[np.isin(tcs, pushed)] += shift
+                rows, zones = occupied(x, depths, tcs)
+        for i, block_x in block:
+            x[i] = offset + block_x
+            occupy(rows, zones, int(depths[i]), x[i] - NODE_WIDTH / 2, tc)
+    return x
+
+def compute_layout(children, order, previous):
+    # Returns {"key", "x", "depth", "parent"} lists for every key but ROOT (x is None for TC compound nodes). Columns rather
+    # than a list per key, much quicker to write and read back. previous is the same thing from an earlier layout, or None
+    # to lay the whole org out fresh
+    depth = {ROOT: 0}
+    parent_of = {ROOT: ROOT}
+    for key in order:
+        for kid in children[key]:
+            depth[kid] = depth[key] + 1
+            parent_of[kid] = key
+    depths = [depth[key] for key in order]
+    parents = [parent_of[key] for key in order]
+    x = relayout(children, order, np.array(depths), parents, previous) if previous else None
+    if x is not None:
+        x = x.tolist()
+    else:
+        x_of = tidy_layout(children, ROOT)[1]
+        x = [x_of[key] for key in order]
+    return {"key": order[1:], "x": [x if depth >= 2 else None for x, depth in zip(x[1:], depths[1:])], "depth": depths[1:],
+            "parent": parents[1:]}
+
+def positions_from_layout(layout):
+    # Absolute {key: {"x", "y"}} for employees. TC compound nodes and ROOT get theirs from their children in cytoscape
+    positions = {key: {"x": x, "y": (depth - 2) * LEVEL_HEIGHT}
+                 for key, x, depth in zip(layout["key"], layout["x"], layout["depth"]) if depth >= 2}
+    positions["Outsider"] = {"x": 0, "y": -2 * LEVEL_HEIGHT}
+    return positions
+
+def layout_cache_entries(cache_dir):
+    # Least recently used first. A layout's mtime is bumped every time it is used
+    return sorted((entry for entry in os.listdir(cache_dir) if entry.startswith(LAYOUT_CACHE_PREFIX) and entry.endswith(".json")),
+                  key=lambda entry: os.path.getmtime(os.path.join(cache_dir, entry)))
+
+@stage("cached_layout_positions", rows=len)
+def cached_layout_positions(df, cache_dir=LAYOUT_CACHE_DIR, hierarchy=None):
+    # Node positions keyed on str(EMP_CODE). Computed once per org structure and kept in cache_dir/org_layout2-<hash>.json
+    # hierarchy: df's OrgHierarchy, if the caller already has it
+    print("Working out the graph layout...")
+    children = build_layout_tree(df, hierarchy if hierarchy is not None else OrgHierarchy(df))
+    order = walk(children)
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f"{LAYOUT_CACHE_PREFIX}{structure_hash(children)}.json")
+
+    if os.path.exists(path):
+        print(f"Loading graph layout from cache: {path}...")
+        with open(path) as f:
+            layout = json.load(f)
+        os.utime(path)
+    else:
+        previous = None
+        entries = layout_cache_entries(cache_dir)
+        if entries: # Most recently used layout, so unchanged subtrees stay where they were on screen
+            try:
+                with open(os.path.join(cache_dir, entries[-1])) as f:
+                    previous = json.load(f)
+            except FileNotFoundError: # Evicted by another build meanwhile, laid out fresh
+                pass
+        layout = compute_layout(children, order, previous)
+        tmp_path = temp_path(path)
+        with open(tmp_path, "w") as f:
+            f.write(json.dumps(layout)) # dumps goes through the C encoder, dump does not
+        os.replace(tmp_path, path)
+        for entry in entries[:max(len(entries) + 1 - LAYOUT_CACHE_KEEP, 0)]:
+            print(f"Evicting least recently used graph layout: {entry}...")
+            try:
+                os.remove(os.path.join(cache_dir, entry))
+            except FileNotFoundError: # Another build evicted it too
+                pass
+    print("Gotcha!")
+    return positions_from_layout(layout)
@@ -1,57 +1,288 @@
 # Remember to change the virtual env
 
-from dash_bootstrap_components._components.Col import Col
 import plotly.express as px
 import pandas as pd
+import numpy as np
 
 import dash
 from dash import dcc, html
 from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
 import dash_bootstrap_components as dbc
 
-import webbrowser as wb
+import os
+import re
+import subprocess
+import sys
+import threading
 
-def load_n_prep_data(filename):
-    print(f"Loading data from : {filename}...")
-    cv_df = pd.read_csv(filename,parse_dates=["Date"])
-    cv_df = cv_df.set_index(["Date"]) # sets index on Date column, useful for merge etc later
-    
-    print("Calculating 'Active' metric from the daily records...")
-    # cv_df['Active'] = cv_df.apply(lambda row: row.Confirmed - row.Recovered - row.Deceased, axis=1) #slower than below
-    cv_df['Active'] = cv_df['Confirmed'] - cv_df['Recovered'] - cv_df['Deceased'] # faster than above
-    
+from data_cache import cached_entry, REMOTE_TTL_S
+from downsample import downsample_fig, count_points
+from fig_payload import compact_fig, add_response_compression
+from lru_cache import LRUCache
+from shared_frame import SharedFrame
+from instrument import stage, add_metrics_route
+from background_load import BackgroundLoad, add_health_routes, open_browser_when_ready
+
+FRAME_CACHE_SIZE = 16 # Filtered frames, one per distinct filter
+FIG_CACHE_SIZE = 64 # Serialized figures, one per (metric, filter, option, granularity)
+SENT_CACHE_SIZE = 32 # Downsampled/compacted figures, one per figure and zoom range. Apart, so zooming never evicts a figure
+COMPACT_FIGURES = True # Typed arrays, x0/dx dates and shared trace attributes in the callback responses (fig_payload.py)
+
+# Filters made only of State/District ==/!= terms joined by "and", after normalize_filter. These skip DataFrame.query
+SIMPLE_TERM = r'(State|District)(==|!=)"([^"]*)"'
+SIMPLE_FILTER = re.compile(rf"{SIMPLE_TERM}(?:(?: and |&){SIMPLE_TERM})*")
+
+DATA_SOURCE = 'https://data.covid19india.org/csv/latest/districts.csv' # or "data/districts.csv"
+APP_URL = 'http://127.0.0.1:8050/'
+LOAD_POLL_MS = 1000 # How often the page asks whether the data is ready, while it is loading
+SHARED_NAME = "covid" # Name of the frame published for the workers of a multi worker server, see shared_server
+PUBLISH_BUSY = 3 # Exit code of `python plotly_explore.py publish` when another process is already publishing
+
+CSV_CHUNKSIZE = 250_000 # Rows of districts.csv parsed at a time. None reads the whole file in one go
+KEY_COLS = ["State","District"]
+
+ROLLING_WINDOW = "7D" # Rolling mean of every <metric>_i over this many days, as <metric>_i<ROLLING_SUFFIX>
+ROLLING_SUFFIX = "_7d"
+
+# Rollup cube: the frame at every granularity (pandas offset alias, None for the daily rows as loaded) and level.
+# Levels are a subset of the rows, smallest first, each with the filter term that selects it
+GRANULARITIES = {"D": None, "W": "W", "M": "M"}
+LEVEL_FILTERS = {"country": 'State=="Country"', "state": 'District=="All_Districts"', "district": None}
+
+def downcast_metrics(df):
+    # Metrics are whole numbers stored as float64 in the csv. Columns without gaps become the smallest int that fits them
+    for col in df.columns.drop(KEY_COLS, errors="ignore"):
+        df[col] = pd.to_numeric(df[col], downcast="integer")
+    return df
+
+def unify_categories(parts, cols):
+    # pd.concat only keeps a categorical column categorical if every part has the same categories
+    parts = [part.copy(deep=False) for part in parts] # Columns are swapped below, the callers' frames are left alone
+    for col in cols:
+        for part in parts:
+            part[col] = part[col].astype("category") # No-op if it already is
+        categories = pd.api.types.union_categoricals([part[col] for part in parts]).categories
+        for part in parts:
+            part[col] = part[col].cat.set_categories(categories)
+    return parts
+
+@stage("read_district_chunks", rows=lambda result: sum(len(part) for part in result[0]))
+def read_district_chunks(filename, chunksize=CSV_CHUNKSIZE, after=None):
+    # District rows (with 'Active') and per chunk State level partial sums. Only dates later than after, if given
+    reader = pd.read_csv(filename, parse_dates=["Date"], index_col="Date", # Date index, useful for merge etc later
+                         dtype={"State":"category","District":"category"}, chunksize=chunksize)
+    chunks = [reader] if chunksize is None else reader
+
+    district_parts = []
+    state_partial_sums = [] # A Date can span two chunks, so these are summed again once all chunks are read
+    for chunk in chunks:
+        if after is not None:
+            chunk = chunk[chunk.index > after]
+            if chunk.empty:
+                continue
+        print(f"Calculating 'Active' metric and State level partial sums for {len(chunk)} rows...")
+        # chunk['Active'] = chunk.apply(lambda row: row.Confirmed - row.Recovered - row.Deceased, axis=1) #slower than below
+        chunk['Active'] = chunk['Confirmed'] - chunk['Recovered'] - chunk['Deceased'] # faster than above
+        state_partial_sums.append(chunk.groupby(['Date','State'], observed=True).sum(numeric_only=True))
+        district_parts.append(downcast_metrics(chunk))
+    return district_parts, state_partial_sums
+
+@stage("add_rollup_levels")
+def add_rollup_levels(district_parts, state_partial_sums):
     print("Calculating the State level sum of daily metrics by adding all District level data...")
-    state_level_sum = cv_df.groupby(['Date','State']).sum().reset_index() # reset_index is required to flatten out the table, otherwise group by creates a multiindex on [Date, State]
-    state_level_sum["District"] = "All_Districts"
+    state_level_sum = pd.concat(state_partial_sums).groupby(['Date','State'], observed=True).sum().reset_index() # reset_index is required to flatten out the table, otherwise group by creates a multiindex on [Date, State]
+    state_level_sum["District"] = pd.Categorical(["All_Districts"] * len(state_level_sum))
     state_level_sum = state_level_sum.set_index(["Date"]) # indexing back on Date as reset_index clears index from above
-    cv_df = cv_df.append(state_level_sum)
 
     print("Calculating the country level sum of daily metrics by adding all State level data...")
-    country_level_sum = state_level_sum.groupby(['Date']).sum().reset_index()
-    country_level_sum["State"] = "Country"
-    country_level_sum["District"] = "All_Districts"
+    country_level_sum = state_level_sum.groupby(['Date']).sum(numeric_only=True).reset_index()
+    country_level_sum["State"] = pd.Categorical(["Country"] * len(country_level_sum))
+    country_level_sum["District"] = pd.Categorical(["All_Districts"] * len(country_level_sum))
     country_level_sum = country_level_sum.set_index(["Date"])
-    cv_df = cv_df.append(country_level_sum)
-
-    print("Calculating incremental metrics from daily metrics and merging data...")
-    sd_groups = cv_df.groupby(['State','District']) # sd_groups is a DataFrameGroupBy Object, with first 2 columns as State, District
-    group_list = []
-  
-    for name, group in sd_groups: # name is a tuple, group is a Dataframe
-        num_cols = group.iloc[:,2:] # Removes the State, District index columns, so that the rest are all numerical metrics
-        num_cols = num_cols.diff() # Does a diff between current row and previous row. First row will be nan
-        num_cols.insert(0,'State',name[0]) # name contains the indexed columns State, District. Adding back
-        num_cols.insert(1,'District',name[1])
-        group_list.append(num_cols) # num_cols is a Dataframe appended to a list
-   
-    cv_df_i = pd.concat(group_list) # concatenates a list of Dataframes
-    cv_df_i = cv_df_i.rename(columns={"Confirmed" : "Confirmed_i", "Recovered":"Recovered_i","Deceased":"Deceased_i","Other":"Other_i","Tested":"Tested_i","Active":"Active_i"})
-    cv_df = pd.merge(cv_df, cv_df_i, on = ["Date","State","District"])
+
+    # One concat at the end instead of copying the full frame on every append
+    parts = district_parts + [downcast_metrics(state_level_sum), downcast_metrics(country_level_sum)]
+    parts = unify_categories(parts, KEY_COLS)
+    return pd.concat(parts)[district_parts[0].columns] # Rollups come out of groupby with their columns in another order
+
+@stage("load_n_prep_data")
+def load_n_prep_data(filename, chunksize=CSV_CHUNKSIZE):
+    print(f"Loading data from : {filename}...")
+    district_parts, state_partial_sums = read_district_chunks(filename, chunksize)
+    cv_df = add_rollup_levels(district_parts, state_partial_sums)
+    del district_parts
+
+    print("Calculating incremental metrics from daily metrics...")
+    cv_df = calc_incremental_metrics(cv_df)
+
+    print(f"Calculating {ROLLING_WINDOW} rolling means of incremental metrics...")
+    cv_df = calc_rolling_means(cv_df)
     return cv_df
 
-def prep_fig(cv_df, filter='District=="All_Districts"', metric='Active', option=3):
+@stage("refresh_n_prep_data")
+def refresh_n_prep_data(cv_df, filename, chunksize=CSV_CHUNKSIZE):
+    # Adds the dates of filename later than the last Date in cv_df (a frame from load_n_prep_data), without redoing the rest
+    last_date = cv_df.index.max()
+    print(f"Loading data after {last_date:%Y-%m-%d} from : {filename}...")
+    district_parts, state_partial_sums = read_district_chunks(filename, chunksize, after=last_date)
+    if not district_parts:
+        print("No new dates, nothing to refresh...")
+        return cv_df
+    new_df = add_rollup_levels(district_parts, state_partial_sums)
+
+    print(f"Calculating incremental metrics for {len(new_df)} new rows...")
+    # The last known row of every State, District goes first, so the first new row diffs against it. Dropped after the diff
+    last_rows = cv_df[new_df.columns].groupby(KEY_COLS, sort=False, observed=True).tail(1)
+    new_df = calc_incremental_metrics(pd.concat(unify_categories([last_rows, new_df], KEY_COLS)))
+    new_df = new_df.iloc[len(last_rows):]
+
+    # Same for the rolling means, with every known row still inside the window of the first new date in front
+    window_rows = cv_df[cv_df.index > last_date - pd.Timedelta(ROLLING_WINDOW)]
+    new_df = calc_rolling_means(pd.concat(unify_categories([window_rows, new_df], KEY_COLS)))
+    new_df = new_df.iloc[len(window_rows):]
+
+    # Same row order as a full load: every level's rows together, districts, then states, then the country, each by date
+    cv_df = pd.concat(unify_categories([cv_df, new_df], KEY_COLS))
+    level = np.where(cv_df["State"] == "Country", 2, np.where(cv_df["District"] == "All_Districts", 1, 0))
+    return cv_df.iloc[np.argsort(level, kind="stable")]
+
+@stage("calc_incremental_metrics")
+def calc_incremental_metrics(cv_df):
+    # Adds a <metric>_i column per numerical metric, the diff between current and previous row of the same State, District
+    # Single grouped diff instead of looping over every group, diffing and merging the pieces back on Date, State, District
+    metric_cols = [col for col in cv_df.columns if col not in ("State","District")]
+    cv_df_i = cv_df.groupby(['State','District'], sort=False, observed=True)[metric_cols].diff() # Same row order as cv_df. First row of every group will be nan
+    cv_df[[f"{col}_i" for col in metric_cols]] = cv_df_i.to_numpy()
+    return cv_df
+
+@stage("calc_rolling_means")
+def calc_rolling_means(cv_df, window=ROLLING_WINDOW):
+    # Adds <metric>_i_7d per incremental metric: mean of the known values over the rows of the same State, District dated
+    # within the last window (so gaps in the dates don't stretch it), like rolling(window, min_periods=1).mean() per group.
+    # As float32, plenty for plotting. Running sums instead of groupby().rolling(), which returns the rows in another order
+    cols = [col for col in cv_df.columns if col.endswith("_i")]
+    group = cv_df.groupby(KEY_COLS, sort=False, observed=True).ngroup().to_numpy()
+    seconds = (cv_df.index - cv_df.index.min()).total_seconds().to_numpy().astype(np.int64)
+    window_s = int(pd.Timedelta(window).total_seconds())
+    order = np.lexsort((seconds, group)) # Group by group, each by date, so every window is a run of rows ending at its own row
+
+    # One sort key for group and date. Groups are spaced so a window never reaches back into the previous group
+    key = group[order] * (seconds.max() + window_s + 1) + seconds[order]
+    starts = np.searchsorted(key, key - window_s, side="right") # First row after the window's (open) left end
+    values = cv_df[cols].to_numpy(dtype=np.float64)[order]
+    known = ~np.isnan(values)
+    sums = np.vstack([np.zeros((1, len(cols))), np.cumsum(np.where(known, values, 0), axis=0)])
+    counts = np.vstack([np.zeros((1, len(cols))), np.cumsum(known, axis=0)])
+    rows = np.arange(1, len(order) + 1)
+    with np.errstate(invalid="ignore", divide="ignore"): # 0/0 is nan, a window without any known value
+        means = (sums[rows] - sums[starts]) / (counts[rows] - counts[starts])
+    means[np.isnan(means)] = np.nan # 0/0 is nan with the sign bit set, which would change the frame's hash once cached
+
+    rolled = np.empty_like(means, dtype=np.float32)
+    rolled[order] = means
+    cv_df[[col + ROLLING_SUFFIX for col in cols]] = rolled
+    return cv_df
+
+def bucket_data(cv_df, freq):
+    # One row per State, District and period, dated on the period's last day: cumulative metrics as at the end of the period,
+    # incremental ones summed over it (nan if none known). Rolling means are dropped, they only make sense on daily rows
+    incremental_cols = [col for col in cv_df.columns if col.endswith("_i")]
+    cumulative_cols = [col for col in cv_df.columns if col not in KEY_COLS and not col.endswith(("_i", ROLLING_SUFFIX))]
+    grouped = cv_df.groupby(KEY_COLS + [pd.Grouper(level=cv_df.index.name, freq=freq)], sort=False, observed=True)
+    bucketed = pd.concat([grouped[cumulative_cols].last(), grouped[incremental_cols].sum(min_count=1)], axis=1)
+    bucketed = bucketed.reset_index(KEY_COLS)[KEY_COLS + cumulative_cols + incremental_cols]
+    return bucketed.sort_index(kind="stable") # Date major, like the daily rows
+
+def normalize_filter(filter):
+    # Same key for filters that only differ in quotes or spacing, e.g. State == 'Kerala' and State=="Kerala"
+    parts = re.split(r"(\"[^\"]*\"|'[^']*')", (filter or "").strip()) # Odd positions are the quoted strings, left untouched
+    for i, part in enumerate(parts):
+        if i % 2:
+            parts[i] = '"' + part[1:-1] + '"'
+        else:
+            parts[i] = re.sub(r"\s*([=!<>&|~(),])\s*", r"\1", re.sub(r"\s+", " ", part))
+    return "".join(parts)
+
+def build_filter_index(cv_df):
+    # Sorted row positions of every State and every District value, built once per loaded frame
+    # Rollup levels fall out of these: District=="All_Districts" are the state and country rows, State=="Country" the country rows
+    print("Building the State/District filter index...")
+    return {
+        "rows": len(cv_df),
+        "State": cv_df.groupby('State', sort=False).indices, # dict of value -> positions array
+        "District": cv_df.groupby('District', sort=False).indices,
+    }
+
+def resolve_filter(filter_index, filter):
+    # Row positions matching filter, or None if it is not a simple State/District filter
+    norm = normalize_filter(filter)
+    if not SIMPLE_FILTER.fullmatch(norm):
+        return None
+    empty = np.array([], dtype=np.intp)
+    positions = None
+    excluded = []
+    for col, op, value in re.findall(SIMPLE_TERM, norm):
+        matches = filter_index[col].get(value, empty)
+        if op == "==":
+            positions = matches if positions is None else np.intersect1d(positions, matches, assume_unique=True)
+        else:
+            excluded.append(matches)
+    if positions is None: # Only != terms
+        positions = np.arange(filter_index["rows"])
+    for matches in excluded:
+        positions = np.setdiff1d(positions, matches, assume_unique=True)
+    return positions
+
+@stage("build_rollup_cube", rows=lambda cube: sum(len(entry["cv_df"]) for entry in cube.values()))
+def build_rollup_cube(cv_df):
+    # {(granularity, level): {"cv_df", "filter_index", "frame_cache"}} for every GRANULARITIES x LEVEL_FILTERS.
+    # Daily/district is cv_df itself, everything else is smaller: a slice of it, or of a bucketed frame
+    cube = {}
+    for granularity, freq in GRANULARITIES.items():
+        if freq is not None:
+            print(f"Bucketing daily metrics by {freq}...")
+        frame = cv_df if freq is None else bucket_data(cv_df, freq)
+        filter_index = build_filter_index(frame)
+        for level, level_filter in LEVEL_FILTERS.items():
+            level_df = frame if level_filter is None else frame.iloc[resolve_filter(filter_index, level_filter)]
+            cube[(granularity, level)] = {
+                "cv_df": level_df,
+                "filter_index": filter_index if level_filter is None else build_filter_index(level_df),
+                "frame_cache": LRUCache(FRAME_CACHE_SIZE), # Per entry, the same filter gives different rows at another granularity
+            }
+    return cube
+
+def cube_level(filter):
+    # Smallest level holding every row filter can match: one whose filter term is required by filter (an "and" of terms)
+    norm = normalize_filter(filter)
+    if "(" in norm or "|" in norm or " or " in norm:
+        return "district"
+    terms = set(re.split(r" and |&", norm))
+    return next(level for level, level_filter in LEVEL_FILTERS.items() if level_filter is None or level_filter in terms)
+
+def metric_column(metric, granularity="D", smoothing=False):
+    # Column plotted for metric: its rolling mean for a smoothed daily incremental metric
+    if smoothing and granularity == "D" and metric.endswith("_i"):
+        return metric + ROLLING_SUFFIX
+    return metric
+
+@stage("query_data")
+def query_data(cv_df, filter, filter_index=None):
+    positions = resolve_filter(filter_index, filter) if filter_index else None
+    if positions is None:
+        return cv_df.query(filter)
+    return cv_df.iloc[positions] # Same rows, in the same order, as cv_df.query(filter)
+
+def filter_data(cv_df, filter, frame_cache=None, filter_index=None):
+    if frame_cache is None:
+        return query_data(cv_df, filter, filter_index)
+    return frame_cache.get_or_set(normalize_filter(filter), lambda: query_data(cv_df, filter, filter_index))
+
+@stage("prep_fig", rows=lambda fig: sum(len(trace.x) for trace in fig.data if trace.x is not None) if fig else 0) # Points plotted
+def prep_fig(cv_df, filter='District=="All_Districts"', metric='Active', option=3, frame_cache=None, filter_index=None):
     print(f"Applying filter: {filter}...")
-    cv_df = cv_df.query(filter)
+    cv_df = filter_data(cv_df, filter, frame_cache, filter_index) # May be shared through frame_cache, so not modified in place below
     
     print(f"Preparing Graph option {option} for {metric} ...")
     fig={}
@@ -63,7 +294,8 @@ def prep_fig(cv_df, filter='District=="All_Districts"', metric='Active', option=
         fig.update_traces(mode="markers+lines", hovertemplate='Date:%{x}<br>Cases:%{y}')
         fig.update_layout(hovermode="closest", showlegend=False)
     elif(option == 2):
-        cv_df['State-District'] = cv_df.apply(lambda row: row.State + "-" + row.District, axis = 1)
+        # cv_df['State-District'] = cv_df.apply(lambda row: row.State + "-" + row.District, axis = 1) # slower than below, and modifies the filtered frame
+        cv_df = cv_df.assign(**{'State-District': cv_df['State'].astype(str) + "-" + cv_df['District'].astype(str)}) # State, District are categorical
         fig = px.line(cv_df, y=metric, title = metric, color="State-District")
         fig.update_traces(mode="markers+lines")
         fig.update_layout(hovermode="closest", showlegend=False)
@@ -81,7 +313,88 @@ def prep_fig(cv_df, filter='District=="All_Districts"', metric='Active', option=
     print("Ready to show graph...")
     return fig
 
-def prep_dash(cv_df):
+@stage("serialize_fig", rows=lambda fig: None)
+def serialize_fig(fig):
+    # Plain dict of the figure, so a cache hit skips rebuilding the plotly Figure object
+    return fig.to_plotly_json() if fig else fig
+
+@stage("sent_fig", rows=lambda fig: None)
+def sent_fig(fig, x_range=None):
+    # What goes to the browser for a serialized figure: downsampled to the visible range, compacted if COMPACT_FIGURES
+    fig = downsample_fig(fig, x_range)
+    return compact_fig(fig) if COMPACT_FIGURES else fig
+
+def zoom_range(relayout_data):
+    # x axis range from a graph's relayoutData: (start, end) after a zoom/pan, None after a reset (full range),
+    # False if the event didn't touch the x axis (autosize, y only zoom...)
+    if not relayout_data:
+        return False
+    if "xaxis.range[0]" in relayout_data:
+        return (relayout_data["xaxis.range[0]"], relayout_data["xaxis.range[1]"])
+    if "xaxis.range" in relayout_data:
+        return tuple(relayout_data["xaxis.range"])
+    if relayout_data.get("xaxis.autorange"):
+        return None
+    return False
+
+def loading_fig(text):
+    # Empty serialized figure with text in the middle, shown until the data is ready
+    return {"data": [], "layout": {"xaxis": {"visible": False}, "yaxis": {"visible": False},
+                                   "annotations": [{"text": text, "xref": "paper", "yref": "paper", "x": 0.5, "y": 0.5,
+                                                    "showarrow": False, "font": {"size": 24}}]}}
+
+def prep_dash(cv_df=None, reload=None, shared=None, load=None):
+    # reload, if given, returns a fresh cv_df (e.g. from refresh_n_prep_data), or None if the data didn't change, and is run
+    # on POST /refresh
+    # shared, a shared_frame.SharedFrame, makes the app use the frame another process published instead of cv_df (can be None),
+    # and switch to every newer generation published, by POST /refresh in any worker or by the loader.
+    # reload then only starts publishing the next generation (e.g. start_publisher) and returns False if another process
+    # already is. POST /refresh answers 202 right away
+    # load, if given instead of cv_df, returns the cv_df. It runs in a background thread, cube included, once app.pending.start()
+    # is called, and the app serves a loading state until it is done. Readiness at GET /health and /ready (background_load.py)
+    # Everything the callbacks need from one loaded frame lives in live["data"], replaced as a whole by swap_data,
+    # so a callback running during a refresh sees either all old or all new data, and never caches old figures as new ones
+    live = {}
+    refresh_lock = threading.Lock()
+    swap_lock = threading.Lock()
+
+    def swap_data(new_cv_df, generation=None):
+        live["data"] = {
+            "generation": generation if generation is not None else live["data"]["generation"] + 1 if live else 0,
+            "cv_df": new_cv_df,
+            "cube": build_rollup_cube(new_cv_df),
+            "fig_cache": LRUCache(FIG_CACHE_SIZE),
+            "sent_cache": LRUCache(SENT_CACHE_SIZE),
+        }
+
+    def current_data():
+        # None while there is nothing to show yet
+        if shared is not None:
+            try:
+                generation, shared_cv_df = shared.current()
+            except FileNotFoundError: # The loader hasn't published yet
+                return None
+            if not live or live["data"]["generation"] != generation:
+                with swap_lock: # One thread of this worker builds the new filter index, the others wait for it
+                    if not live or live["data"]["generation"] != generation:
+                        swap_data(shared_cv_df, generation)
+        return live.get("data")
+
+    pending = BackgroundLoad(lambda: swap_data(load()), "covid data") if load is not None else None
+    if shared is not None:
+        current_data()
+    elif pending is None:
+        swap_data(cv_df)
+
+    def status():
+        data = current_data()
+        if pending is not None and data is None:
+            return pending.status()
+        current = {"name": "covid data", "state": "ready" if data else "loading", "ready": data is not None}
+        if data:
+            current.update(generation=data["generation"], rows=len(data["cv_df"]))
+        return current
+
     # create dash app
     app = dash.Dash(external_stylesheets=[dbc.themes.LUX])
 
@@ -108,6 +421,19 @@ def prep_dash(cv_df):
                     value='District=="All_Districts" and State!="Country"'),
                 ], width=4
             ),
+            dbc.Col([
+                html.P("Granularity:"),
+                dcc.RadioItems(id = 'granularity',
+                    options=[{'label': 'Daily', 'value': 'D'},
+                            {'label': 'Weekly', 'value': 'W'},
+                            {'label': 'Monthly', 'value': 'M'}],
+                    value='D'),
+                html.P("Smoothing:"),
+                dcc.Checklist(id = 'smoothing',
+                    options=[{'label': ' 7 day mean (daily _i metrics)', 'value': 'rolling'}],
+                    value=[]),
+                ], width=2
+            ),
             dbc.Col([
                 html.P("Graph Option:"),
                 dcc.RadioItems(id = 'option',
@@ -117,13 +443,15 @@ def prep_dash(cv_df):
                             {'label': '4' , 'value': 4},
                             {'label': '5' , 'value': 5}],
                     value=3),
-                ], width=4
+                ], width=2
             ) 
         ]),
         dbc.Row([
-            dbc.Col(
+            dbc.Col([
+                html.Div(id='load-status'),
                 dcc.Graph(id='graph1', figure={}, responsive=True, style={'height': '900px'}),
-                width=12
+                dcc.Interval(id='load-poll', interval=LOAD_POLL_MS), # Re-runs update_graph until the data is ready
+                ], width=12
             )
         ])
     ])
@@ -131,24 +459,155 @@ def prep_dash(cv_df):
     # ------------------------------------------------------------------------------
     # Connect the Plotly graphs with Dash Components
     @app.callback(
-        [Output(component_id='graph1', component_property='figure')],
+        [Output(component_id='graph1', component_property='figure'),
+        Output(component_id='load-poll', component_property='disabled'),
+        Output(component_id='load-status', component_property='children')],
         [Input(component_id='metric', component_property='value'),
         Input(component_id='filter', component_property='value'),
-        Input(component_id='option', component_property='value')]
+        Input(component_id='option', component_property='value'),
+        Input(component_id='granularity', component_property='value'),
+        Input(component_id='smoothing', component_property='value'),
+        Input(component_id='graph1', component_property='relayoutData'), # Zoom/pan, to re-fetch the zoomed range at full resolution
+        Input(component_id='load-poll', component_property='n_intervals')]
     )
-    def update_graph(metric, filter, option):
-        print(metric, filter, option)
+    @stage("update_graph", rows=lambda result: count_points(result[0]) if result[0] else 0) # Points sent to the browser
+    def update_graph(metric, filter, option, granularity, smoothing, relayout_data, n_intervals):
+        data = current_data()
+        if data is None: # Still loading: a placeholder, and the poll keeps going until the data is ready (or failed to load)
+            current = status()
+            failed = current["state"] == "failed"
+            text = f"Loading data failed: {current['error']}" if failed else f"Loading data... {current.get('seconds', 0):.0f}s"
+            return [loading_fig(text), failed, text]
+        print(metric, filter, option, granularity, smoothing)
+        x_range = None # Full date range, whenever the metric, filter or option changes (or the data just got ready)
+        if dash.callback_context.triggered[0]["prop_id"].startswith("graph1."):
+            x_range = zoom_range(relayout_data)
+            if x_range is False:
+                raise PreventUpdate
+        metric = metric_column(metric, granularity, bool(smoothing))
+        key = (metric, normalize_filter(filter), option, granularity)
+        entry = data["cube"][(granularity, cube_level(filter))] # Smallest frame with every row the filter can match
+        fig = data["fig_cache"].get_or_set(key, lambda: serialize_fig(
+            prep_fig(entry["cv_df"], filter, metric, option, entry["frame_cache"], entry["filter_index"])))
+        fig = data["sent_cache"].get_or_set(key + (x_range,), lambda: sent_fig(fig, x_range))
+        if fig:
+            fig = dict(fig, layout=dict(fig["layout"], uirevision=str(key))) # Keeps the user's zoom when the zoomed in data arrives
+        return [fig, True, ""] # The return needs to be a List of some reason!
+
+    @app.server.route("/cache_stats")
+    def cache_stats():
+        data = current_data()
+        if data is None:
+            return status(), 503
+        frames = {f"{granularity}/{level}": entry["frame_cache"].stats() for (granularity, level), entry in data["cube"].items()}
+        return {"generation": data["generation"], "frames": frames, "figures": data["fig_cache"].stats(),
+                "sent": data["sent_cache"].stats()}
 
-        return [prep_fig(cv_df, filter, metric, option)] # The return needs to be a List of some reason!
+    @app.server.route("/refresh", methods=["POST"])
+    def refresh():
+        if reload is None:
+            return {"error": "no reload function given to prep_dash"}, 404
+        if pending is not None and not pending.done.is_set():
+            return {"error": "initial load still running"}, 409
+        if not refresh_lock.acquire(blocking=False):
+            return {"error": "refresh already running"}, 409
+        try:
+            if shared is not None:
+                if not reload(): # Every worker, this one included, switches over on its first request once it is published
+                    return {"error": "refresh already running"}, 409
+                data = current_data()
+                return {"status": "publishing", "generation": data["generation"] if data is not None else None}, 202
+            cv_df = reload()
+            if cv_df is None: # Same data as shown: no new generation, the caches stay
+                return {"status": "unchanged", "generation": current_data()["generation"]}
+            swap_data(cv_df)
+        finally:
+            refresh_lock.release()
+        data = current_data()
+        return {"generation": data["generation"], "rows": len(data["cv_df"]), "last_date": f"{data['cv_df'].index.max():%Y-%m-%d}"}
 
+    add_metrics_route(app.server) # Per stage timings, see instrument.py
+    add_health_routes(app.server, status)
+    add_response_compression(app.server)
+    app.swap_data = swap_data # Hot swap the frame from Python, e.g. app.swap_data(refresh_n_prep_data(cv_df, filename))
+    app.pending = pending
     return app
 
+def reload_data(filename=DATA_SOURCE, max_age=REMOTE_TTL_S, known_entry=None):
+    # (cv_df, its cache entry). cv_df is None if the entry is known_entry, the data the caller already has (see cached_entry)
+    # Only new dates are added to a cached frame
+    return cached_entry(filename, load_n_prep_data, refresh=refresh_n_prep_data, max_age=max_age, known_entry=known_entry)
+
+def data_reloader(filename=DATA_SOURCE):
+    # (load, reload) for prep_dash. reload checks the source right away, not only once REMOTE_TTL_S passed as load does,
+    # and returns None if it is the data load or reload returned last
+    current = {"entry": None}
+
+    def load(max_age=REMOTE_TTL_S):
+        cv_df, entry = reload_data(filename, max_age, current["entry"])
+        current["entry"] = entry
+        return cv_df
+    return load, lambda: load(max_age=0)
+
+def publish_data(shared, max_age=REMOTE_TTL_S):
+    # Publishes the next generation of the frame, unless it is the data already published. Returns the generation, None if
+    # unchanged. The caller holds shared's publish lock
+    cv_df, entry = reload_data(max_age=max_age, known_entry=shared.published_source())
+    if cv_df is None:
+        print(f"{shared.name} is already published from this data, generation unchanged...")
+        return None
+    return shared.publish(cv_df, source=entry)
+
+def start_publisher(shared):
+    # POST /refresh of shared_server: starts the publisher in its own process and returns. The frame it loads doesn't stay in
+    # the worker, which only maps the published generation, and the request doesn't wait out the load (worker timeouts).
+    # The publish lock is taken here, so a second refresh is turned down at once, and released by the publisher when done.
+    # False if another process is publishing
+    stamp = shared.take_publish_lock()
+    if stamp is None:
+        return False
+    try:
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "publish", "--locked"], start_new_session=True)
+    except BaseException:
+        shared.release_publish_lock(stamp)
+        raise
+
+    def reap():
+        returncode = process.wait()
+        if returncode:
+            print(f"Publisher failed with exit code {returncode}...")
+            shared.release_publish_lock(stamp) # In case it died before releasing it
+    threading.Thread(target=reap, name="publisher", daemon=True).start()
+    return True
+
+def shared_server():
+    # WSGI app for a multi worker server, e.g. gunicorn -w 4 "plotly_explore:shared_server()"
+    # The workers map the frame published by `python plotly_explore.py publish` instead of each loading their own copy
+    shared = SharedFrame(SHARED_NAME)
+    return prep_dash(None, lambda: start_publisher(shared), shared).server
+
 def main():
-    filename = 'https://data.covid19india.org/csv/latest/districts.csv'
-    # filename = "data/districts.csv"
-    cv_df = load_n_prep_data(filename)
-    wb.open_new_tab('http://127.0.0.1:8050/')
-    prep_dash(cv_df).run_server(debug=False)
+    if sys.argv[1:] == ["publish"]: # Loader for shared_server: prepares the frame once, for all the workers
+        shared = SharedFrame(SHARED_NAME)
+        with shared.publish_lock() as acquired:
+            if not acquired:
+                print(f"Another process is publishing {shared.name}, skipping...")
+                raise SystemExit(PUBLISH_BUSY)
+            publish_data(shared)
+        return
+    if sys.argv[1:] == ["publish", "--locked"]: # Started by start_publisher on POST /refresh, which took the publish lock for it
+        shared = SharedFrame(SHARED_NAME)
+        try:
+            publish_data(shared, max_age=0)
+        finally:
+            shared.release_publish_lock()
+        return
+    # Serves right away, the data loads in the background. The tab opens once the server answers, and fills in when it is ready
+    load, reload = data_reloader()
+    app = prep_dash(reload=reload, load=load)
+    app.pending.start()
+    open_browser_when_ready(APP_URL)
+    app.run(debug=False) # curl -X POST http://127.0.0.1:8050/refresh to pick up a new districts.csv
 
 if __name__ == "__main__":
     main()
@@ -1,9 +1,16 @@
 # Idea: Version A - Dataframe, native, pyvis; Version B - Dataframe, neo4j, pyvis
 # Coding Version A first
-from pyvis.network import Network
 import pandas as pd
-import math
-import webbrowser as wb 
+import numpy as np
+import os
+import re
+import webbrowser as wb
+
+from cytoscape_explore import map_column # Same lookups, pyvis has its own value tables (dot, hex colors, border 3)
+from org_layout import cached_layout_positions, LAYOUT_CACHE_DIR
+from instrument import stage
+
+CDN_TAG = re.compile(r'\s*<(?:link|script)\b[^>]*\b(?:href|src)="https?://[^"]*"[^>]*>(?:\s*</script>)?') # A tag loading a url
 
 # pyvis node properties. See add_node(...) documentation at https://pyvis.readthedocs.io/en/latest/documentation.html
 # id = emp_code
@@ -13,57 +20,121 @@ import webbrowser as wb
 # shape = Band
 # value = number of reportees
 
+# label inside of it are: ellipse, circle, database, box, text.
+# The ones with the label outside of it are: image, circularImage, diamond, dot, star, triangle, triangleDown, square and icon
+SHAPE_BY_BAND = {**dict.fromkeys(["D","10","09","08"], "square"), **dict.fromkeys(["7B","7A"], "dot"),
+                 **dict.fromkeys(["6G","6A","6B"], "diamond")}
+SHAPE_DEFAULT = "triangle"
+
+COLOR_BY_CITY = {"PUNE": "#009977", "BANGALORE": "#0077BB", "CHENNAI": "#005544",
+                 **dict.fromkeys(["HYDERABAD","MUMBAI","GURGAON","KOLKATA","NOIDA", "AHMEDABAD"], "#A83645")}
+COLOR_DEFAULT = "#CCCCCC"
+
+BORDERWIDTH_BY_STATUS = {"Onboarded_Solar": 3}
+BORDERWIDTH_DEFAULT = 0
+
 def get_shape(band):
-    # label inside of it are: ellipse, circle, database, box, text. 
-    # The ones with the label outside of it are: image, circularImage, diamond, dot, star, triangle, triangleDown, square and icon
-    if band in ["D","10","09","08"]:
-        return "square"
-    elif band in ["7B","7A"]:
-        return "dot"
-    elif band in ["6G","6A","6B"]:
-        return "diamond"
-    else:
-        return "triangle"
+    return SHAPE_BY_BAND.get(band, SHAPE_DEFAULT)
 
 def get_color(city):
-    if city == "PUNE":
-        return "#009977"
-    elif city == "BANGALORE":
-        return "#0077BB"
-    elif city == "CHENNAI":
-        return "#005544"
-    elif city in ("HYDERABAD","MUMBAI","GURGAON","KOLKATA","NOIDA", "AHMEDABAD"):
-        return "#A83645"
-    else:
-        return "#CCCCCC"
+    return COLOR_BY_CITY.get(city, COLOR_DEFAULT)
 
 def get_borderwidth(commercial_status):
-    if(commercial_status == "Onboarded_Solar"):
-        return 3
+    return BORDERWIDTH_BY_STATUS.get(commercial_status, BORDERWIDTH_DEFAULT)
+
+@stage("pyvis_load_data")
+def load_data(filename):
+    return pd.read_excel(filename,engine='openpyxl', index_col='EMP_CODE')
+
+@stage("prep_network_data")
+def prep_network_data(df):
+    # Everything add_node/add_edge used to be called with, as columns. Duplicate EMP_CODEs keep their first row, like add_node
+    df = df[~df.index.duplicated()]
+
+    # EMP_NOTESID -> EMP_CODE, last one wins for a repeated notes id. Anyone whose manager isn't found reports to "Outsider"
+    # A missing EMP_NOTESID isn't a notes id, so it can't be anyone's manager. The add_edge loop this replaced did use it:
+    # everyone with no PEM_NOTESID was linked to the last employee with no EMP_NOTESID. They report to "Outsider" now
+    emp_ids = pd.Series(df.index, index=df['EMP_NOTESID'])
+    emp_ids = emp_ids[emp_ids.index.notna() & ~emp_ids.index.duplicated(keep='last')]
+    pem_pos = emp_ids.index.get_indexer(df['PEM_NOTESID'])
+
+    return pd.DataFrame({
+        "label": [name if name else emp_code for emp_code, name in zip(df.index.tolist(), df['EMP_NAME'].tolist())],
+        "title": [f"{name} ({jrss}) - {tc}, DL: {poc}" for name, jrss, tc, poc in zip(df['EMP_NAME'], df['JRSS'], df['TC'], df['IBM_POC'])],
+        "color": map_column(df['CITY'], COLOR_BY_CITY, COLOR_DEFAULT),
+        "shape": map_column(df['BAND'], SHAPE_BY_BAND, SHAPE_DEFAULT),
+        "borderWidth": map_column(df['COMMERCIAL_STATUS'], BORDERWIDTH_BY_STATUS, BORDERWIDTH_DEFAULT),
+        "PEM_ID": np.where(pem_pos >= 0, emp_ids.to_numpy(dtype=object)[pem_pos], "Outsider"),
+        "TC": df['TC'],
+    }, index=df.index)
+
+def build_network(net_df, positions=None, cdn_resources="local"):
+    # Fills the Network's node and edge lists directly instead of add_node/add_edge per employee,
+    # which re-check every existing node and edge on each call
+    from pyvis.network import Network # Imported here, pyvis pulls in networkx and IPython (most of a second) on import
+    net = Network(height='100%', width='100%', bgcolor='white', font_color='black', cdn_resources=cdn_resources)
+    font = {"color": net.font_color}
+
+    nodes = [{"color": "#97c2fc", "id": "Outsider", "label": "Outsider", "shape": "dot", "font": font}] # net.add_node("Outsider")
+    emp_codes = net_df.index.tolist()
+    for emp_code, label, title, color, shape, border_width in zip(emp_codes, net_df['label'].tolist(), net_df['title'].tolist(),
+            net_df['color'].tolist(), net_df['shape'].tolist(), net_df['borderWidth'].tolist()):
+        nodes.append({"title": title, "borderWidth": border_width, "color": color, "id": emp_code, "label": label,
+                      "shape": shape, "font": font})
+    if positions:
+        for node in nodes:
+            node.update(positions[str(node["id"])])
+
+    # Undirected, so a pair reporting to each other is one edge, as add_edge would have it
+    edges = []
+    seen = set()
+    for source, to in zip(emp_codes, net_df['PEM_ID'].tolist()):
+        pair = frozenset((source, to))
+        if pair not in seen:
+            seen.add(pair)
+            edges.append({"from": source, "to": to})
+
+    net.nodes = nodes
+    net.edges = edges
+    net.node_ids = [node["id"] for node in nodes]
+    net.node_map = {node["id"]: node for node in nodes}
+    return net
+
+@stage("prep_network", rows=lambda net: len(net.nodes))
+def prep_network(df, freeze=False, layout_cache_dir=os.path.join(LAYOUT_CACHE_DIR, "pyvis"), cdn_resources="local"):
+    # Network for df (an extract read with load_data), with the physics settings, ready for write_html/generate_html
+    # freeze=True: positions come from org_layout (cached per org structure) and physics is off,
+    # so large exports open already laid out instead of running the repulsion simulation in the browser
+    # cdn_resources: pyvis' "local", "in_line" (vis.js in the page, see offline_html) or "remote"
+    print(f"Preparing network data for {len(df)} employees...")
+    net_df = prep_network_data(df)
+    positions = cached_layout_positions(net_df, layout_cache_dir) if freeze else None
+    net = build_network(net_df, positions, cdn_resources)
+    if freeze:
+        net.toggle_physics(False)
     else:
-        return 0
-
-df = pd.read_excel("./data/VW_COMMERCIAL_BARCLAYS_INFO_202109161125.xlsx",engine='openpyxl', index_col='EMP_CODE')
-# df = df.iloc[0:100,:]
-
-net = Network(height='100%', width='100%', bgcolor='white', font_color='black')
-net.add_node("Outsider")
-
-emp_id_dict = {}
-for emp in df.itertuples():
-    net.add_node(emp.Index, 
-                    label = emp.EMP_NAME,
-                    title = f"{emp.EMP_NAME} ({emp.JRSS}) - {emp.TC}, DL: {emp.IBM_POC}",
-                    color = get_color(emp.CITY),
-                    shape = get_shape(emp.BAND),
-                    borderWidth = get_borderwidth(emp.COMMERCIAL_STATUS))
-    emp_id_dict[emp.EMP_NOTESID] = emp.Index
-
-for emp in df.itertuples():
-    net.add_edge(emp.Index, emp_id_dict.get(emp.PEM_NOTESID, "Outsider"))
-
-# net.barnes_hut(gravity=-20000,central_gravity=0.05, spring_length=100, overlap=0.05)
-net.repulsion(node_distance=200, central_gravity=0.05, spring_length=100)
-# net.show_buttons(filter_=['physics'])
-net.show('nodes.html')
-wb.open_new_tab('file:///Users/surjitdas/OneDrive/sandbox/Data_visualization/nodes.html')
\ No newline at end of file
+        # net.barnes_hut(gravity=-20000,central_gravity=0.05, spring_length=100, overlap=0.05)
+        net.repulsion(node_distance=200, central_gravity=0.05, spring_length=100)
+    # net.show_buttons(filter_=['physics'])
+    return net
+
+def offline_html(net):
+    # Html page of net that opens without a network connection. With cdn_resources="in_line" vis.js is in the page, but
+    # pyvis' template always adds bootstrap's css/js from a CDN. The graph draws without them, so those tags are dropped
+    return CDN_TAG.sub("", net.generate_html())
+
+def export_pyvis(df, filename='nodes.html', freeze=False, layout_cache_dir=os.path.join(LAYOUT_CACHE_DIR, "pyvis")):
+    # Writes df as a pyvis/vis.js html page, returns the path written
+    net = prep_network(df, freeze, layout_cache_dir)
+    print(f"Writing {filename}...")
+    stage("write_html", rows=lambda result: None)(net.write_html)(filename)
+    return filename
+
+def main():
+    df = load_data("./data/VW_COMMERCIAL_BARCLAYS_INFO_202109161125.xlsx")
+    # df = df.iloc[0:100,:]
+    filename = export_pyvis(df, 'nodes.html', freeze=len(df) > 1000)
+    wb.open_new_tab('file://' + os.path.abspath(filename))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+# Shares a prepared DataFrame between processes, e.g. the workers of a multi worker WSGI server, through memory-mapped Arrow files
+# One process publishes generations of the frame, every other process attaches to the latest one read only, without a copy:
+#   publish_frame(load_n_prep_data(filename), "covid")        # loader
+#   generation, cv_df = SharedFrame("covid").current()       # workers, on every request. Cheap unless there is a new generation
+# <name>-<generation>.arrow holds the frame, <name>.current.json says which generation is live. Replacing the json is the switch
+import contextlib
+import json
+import os
+import threading
+import time
+
+from data_cache import CACHE_DIR
+
+try:
+    import pyarrow as pa
+    from pyarrow import feather
+except ImportError: # pip install pyarrow, needed for the shared mode only
+    pa = None
+
+SHARED_DIR = os.path.join(CACHE_DIR, "shared")
+KEEP_GENERATIONS = 2 # The live one, and the one before for requests still running on it
+LOCK_STALE_S = 3600 # A publish lock older than this was left behind by a dead process
+
+def frame_path(shared_dir, name, generation):
+    return os.path.join(shared_dir, f"{name}-{generation}.arrow")
+
+def pointer_path(shared_dir, name):
+    return os.path.join(shared_dir, f"{name}.current.json")
+
+def read_pointer(shared_dir, name):
+    try:
+        with open(pointer_path(shared_dir, name)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def zero_copy_table(df):
+    # Arrow table that to_pandas can hand back as views of the mapped file: NaN kept as a float value rather than
+    # turned into nulls (which pandas would have to fill back in), one record batch so no column needs concatenating
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    for i, field in enumerate(table.schema):
+        if pa.types.is_floating(field.type) and table.column(i).null_count and field.name in df.columns:
+            table = table.set_column(i, field, pa.array(df[field.name].to_numpy(), from_pandas=False))
+    return table.combine_chunks()
+
+def publish_frame(df, name, shared_dir=SHARED_DIR, source=None):
+    # Writes df as the next generation of name and switches every attached process over to it. Returns the generation
+    # source, e.g. the data cache entry df came from, is kept with it, so a publisher can tell it already published that data
+    os.makedirs(shared_dir, exist_ok=True)
+    pointer = read_pointer(shared_dir, name)
+    generation = pointer["generation"] + 1 if pointer else 0
+    path = frame_path(shared_dir, name, generation)
+    print(f"Publishing generation {generation} of {name} ({len(df)} rows) to {path}...")
+    feather.write_feather(zero_copy_table(df), path + ".tmp", compression="uncompressed", chunksize=max(len(df), 1))
+    os.replace(path + ".tmp", path)
+
+    with open(pointer_path(shared_dir, name) + ".tmp", "w") as f:
+        json.dump({"generation": generation, "path": os.path.basename(path), "rows": len(df), "source": source}, f)
+    os.replace(pointer_path(shared_dir, name) + ".tmp", pointer_path(shared_dir, name)) # Atomic, the generation switch
+
+    for old in range(generation - KEEP_GENERATIONS, -1, -1):
+        old_path = frame_path(shared_dir, name, old)
+        if not os.path.exists(old_path):
+            break
+        try:
+            os.remove(old_path) # Processes still mapping it keep their pages (POSIX)
+        except OSError: # Windows doesn't remove a mapped file. Tried again on the next publish
+            pass
+    return generation
+
+def lock_path(shared_dir, name):
+    return os.path.join(shared_dir, f"{name}.lock")
+
+def take_publish_lock(name, shared_dir=SHARED_DIR):
+    # Takes the lock publish_lock holds, without releasing it, e.g. for a publisher process started next that releases it.
+    # Returns the lock's (inode, mtime), for release_publish_lock, or None if another process is publishing name
+    os.makedirs(shared_dir, exist_ok=True)
+    path = lock_path(shared_dir, name)
+    try:
+        if time.time() - os.path.getmtime(path) > LOCK_STALE_S:
+            os.remove(path)
+    except OSError:
+        pass
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return None
+    stat = os.fstat(fd)
+    os.close(fd)
+    return stat.st_ino, stat.st_mtime_ns
+
+def release_publish_lock(name, shared_dir=SHARED_DIR, stamp=None):
+    # Removes the lock. With the stamp take_publish_lock returned, only if it is still that lock and not a newer one
+    path = lock_path(shared_dir, name)
+    try:
+        stat = os.stat(path)
+        if stamp is None or (stat.st_ino, stat.st_mtime_ns) == tuple(stamp):
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+
+@contextlib.contextmanager
+def publish_lock(name, shared_dir=SHARED_DIR):
+    # Yields True if this process got the lock, False if another one is publishing name. Across processes, unlike threading.Lock
+    stamp = take_publish_lock(name, shared_dir)
+    if stamp is None:
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        release_publish_lock(name, shared_dir, stamp)
+
+class SharedFrame:
+    def __init__(self, name, shared_dir=SHARED_DIR):
+        if pa is None:
+            raise ImportError("pyarrow is needed to share frames between processes, pip install pyarrow")
+        self.name = name
+        self.shared_dir = shared_dir
+        self.generation = None
+        self.df = None
+        self.stamp = None # (inode, mtime) of the pointer file at the last check
+        self.lock = threading.Lock()
+
+    def current(self):
+        # (generation, frame) of the live generation. Only a stat of the pointer file, unless a new generation was published
+        path = pointer_path(self.shared_dir, self.name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            raise FileNotFoundError(f"Nothing published as {self.name} in {self.shared_dir} yet") from None
+        stamp = (stat.st_ino, stat.st_mtime_ns) # os.replace makes a new inode, so this changes on every publish
+        if stamp != self.stamp:
+            with self.lock:
+                if stamp != self.stamp:
+                    pointer = read_pointer(self.shared_dir, self.name)
+                    if pointer["generation"] != self.generation:
+                        self.df = self.attach(os.path.join(self.shared_dir, pointer["path"]))
+                        self.generation = pointer["generation"]
+                    self.stamp = stamp
+        return self.generation, self.df
+
+    def attach(self, path):
+        print(f"Attaching to shared frame: {path}...")
+        table = feather.read_table(path, memory_map=True)
+        # split_blocks keeps one pandas block per column, so the columns stay read only views of the mapping
+        return table.to_pandas(split_blocks=True)
+
+    def publish(self, df, source=None):
+        return publish_frame(df, self.name, self.shared_dir, source)
+
+    def published_source(self):
+        # source of the live generation, None if there is none or it was published without one
+        pointer = read_pointer(self.shared_dir, self.name)
+        return pointer.get("source") if pointer else None
+
+    def publish_lock(self):
+        return publish_lock(self.name, self.shared_dir)
+
+    def take_publish_lock(self):
+        return take_publish_lock(self.name, self.shared_dir)
+
+    def release_publish_lock(self, stamp=None):
+        release_publish_lock(self.name, self.shared_dir, stamp)
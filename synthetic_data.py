@@ -0,0 +1,70 @@
+# Synthetic datasets shaped like the real inputs, used by the bench_*.py scripts
+import numpy as np
+import pandas as pd
+
+DISTRICTS_CSV_STATES = 36 # Roughly the shape of covid19india districts.csv
+DISTRICTS_CSV_DISTRICTS = 800
+DISTRICTS_CSV_DAYS = 560
+
+def make_districts_df(scale=1, days=DISTRICTS_CSV_DAYS, seed=0):
+    # scale multiplies the number of districts, so scale=1 is about the size of districts.csv
+    # Returns a frame with the same columns as the raw csv (Date is a column, not the index)
+    rng = np.random.default_rng(seed)
+    n_districts = DISTRICTS_CSV_DISTRICTS * scale
+    states = np.array([f"State_{i:02d}" for i in range(DISTRICTS_CSV_STATES)])
+    district_state = states[np.arange(n_districts) % DISTRICTS_CSV_STATES]
+    district_name = np.array([f"District_{i:05d}" for i in range(n_districts)])
+    dates = pd.date_range("2020-04-26", periods=days, freq="D")
+
+    # Cumulative metrics, like the raw file: running sum of non negative daily increments
+    daily = rng.poisson(lam=5, size=(days, n_districts, 5)).astype("float64")
+    cumulative = daily.cumsum(axis=0).reshape(days * n_districts, 5)
+
+    df = pd.DataFrame({
+        "Date": np.repeat(dates.values, n_districts),
+        "State": np.tile(district_state, days),
+        "District": np.tile(district_name, days),
+        "Confirmed": cumulative[:,0] + cumulative[:,1] + cumulative[:,2],
+        "Recovered": cumulative[:,1],
+        "Deceased": cumulative[:,2],
+        "Other": cumulative[:,3] // 10,
+        "Tested": cumulative[:,4] * 20,
+    })
+    return df
+
+def write_districts_csv(path, scale=1, days=DISTRICTS_CSV_DAYS, seed=0):
+    make_districts_df(scale, days, seed).to_csv(path, index=False, date_format="%Y-%m-%d")
+    return path
+
+ORG_CITIES = ["PUNE","BANGALORE","CHENNAI","HYDERABAD","MUMBAI","GURGAON","KOLKATA","NOIDA","AHMEDABAD","KOCHI",None]
+ORG_BANDS = ["D","10","09","08","7B","7A","6G","6A","6B","5","4",None]
+ORG_TCS = ["TC02 - Markets Pre Trade","TC11 - Markets Post Trade","TC03 - Personal Banking Processing","TC04 - Retail and Business Lending",
+           "TC05 - Wholesale Lending","TC07 - Merchant Services","TC08 - Cards Platform","TC13 - Secured and Unsecured Fraud",
+           "TC14 - Digital","TC24 - Chief Security Office","TC25 - Risk Finance and Treasury","TC99 - Other",None]
+ORG_STATUSES = ["Onboarded_Solar","Onboarded","Not_Onboarded",None]
+
+def make_org_df(n_employees, seed=0):
+    # Same columns as the VW_COMMERCIAL_BARCLAYS_INFO extracts. Everyone reports to an earlier employee (a tree),
+    # except a few whose manager is missing or not in the extract, who end up under "Outsider"
+    rng = np.random.default_rng(seed)
+    emp_notes = np.array([f"Emp {i}/India/IBM" for i in range(n_employees)], dtype=object)
+    manager = (rng.random(n_employees) * np.arange(n_employees)).astype(np.int64) # Uniform over earlier employees
+    pem_notes = emp_notes[manager].copy()
+    pem_notes[0] = None
+    outsiders = rng.random(n_employees) < 0.01
+    pem_notes[outsiders] = [f"External {i}/IBM" for i in np.flatnonzero(outsiders)]
+    emp_notes[rng.random(n_employees) < 0.005] = None # Some employees have no notes id, so no one can report to them
+
+    pick = lambda options: np.array(options, dtype=object)[rng.integers(0, len(options), n_employees)]
+    return pd.DataFrame({
+        "EMP_CODE": [f"{i:06d}IBM" for i in range(n_employees)],
+        "EMP_NAME": [f"Employee {i}" for i in range(n_employees)],
+        "EMP_NOTESID": emp_notes,
+        "PEM_NOTESID": pem_notes,
+        "BAND": pick(ORG_BANDS),
+        "JRSS": pick(["Application Developer","Test Specialist","Project Manager",None]),
+        "CITY": pick(ORG_CITIES),
+        "TC": pick(ORG_TCS),
+        "IBM_POC": pick(["POC A","POC B","POC C",None]),
+        "COMMERCIAL_STATUS": pick(ORG_STATUSES),
+    })